@@ -2,39 +2,45 @@
 import codecs
 import chardet
 import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
 import os
 import pickle
-import re
 import argparse
+import subprocess
+import sys
+import tempfile
 import time
-
-from mirs import unpickle, getIndex
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pool
+from operator import itemgetter
+
+from mirs import (checkpointsPath, loadCheckpoints, loadPositionList,
+                  positionSlice, unpickle)
+import mirbin
+import mirdict
+import mirio
+import mirprof
+import mirseg
+import mirshard
+import mirstat
+from mirpost import Postings
+from mirtok import CHECKPOINT_SIZE, tokenPositions
 # DEBUG = True
 DEBUG = False
 
 MAXSIZE = 100000
-resplit = re.compile(r'[\W\d_\s]+')
-mixed_miscoded_espurious = {b'\x81': 1,
-                            b'\x8d': 1,
-                            b'\x90': 1,
-                            b'\x9d': 1,
-                            b'\x91': 1}
-
-
-def mixed_decoder(error: UnicodeDecodeError) -> (str, int):
-    global mixed_miscoded_espurious
-    """ Trata erros de decodificação Unicode como sendo Windows-1252"""
-
-    bs: bytes = error.object[error.start: error.end]
-
-    if bs in mixed_miscoded_espurious:  # ignored
-        return '', error.start + 1
-    else:
-        return bs.decode("Windows-1252"), error.start + 1
-    return bs.decode("Windows-1252", errors='ignore'), error.start + 1
-
+HASH_BLOCK = 1 << 20
 
-codecs.register_error("mixed", mixed_decoder)
+# Rough bytes taken in memory by a term, a posting and a position of a
+# SPIMI block, used to keep it under the -m budget
+TERM_COST = 100
+POSTING_COST = 120
+POSITION_COST = 36
 
 
 def parseArgs():
@@ -48,7 +54,41 @@ def parseArgs():
     parser.add_argument('-@', '--instructions', type=argparse.FileType('r'),
                         help='instruction file to be loaded')
 
-    parser.add_argument('-A', '--auxiliary', action='store_true')
+    parser.add_argument('-A', '--auxiliary', action='store_true',
+                        help='index the files added or modified since the '
+                             'last run in a new segment')
+    parser.add_argument('-m', '--memory', type=int, metavar='MB',
+                        help='build the index in sorted runs of about <MB> '
+                             'megabytes, merged from disk at the end')
+    parser.add_argument('-H', '--hash', action='store_true',
+                        help='store a hash of the contents of the files '
+                             'indexed, with -A compare files of unchanged '
+                             'size by it instead of by their mtimes')
+    parser.add_argument('-M', '--merge', action='store_true',
+                        help='merge the segments left by -A runs (-A '
+                             'starts it in the background when needed)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes used to detect '
+                             'encodings and tokenize the files')
+    parser.add_argument('-S', '--shards', type=int, metavar='N',
+                        help='partition the files in <N> shards indexed on '
+                             'their own, queried in parallel by mirs.py '
+                             '(not with -A or -M)')
+    parser.add_argument('--readers', type=int, default=1, metavar='N',
+                        help='files each process reads ahead of detecting '
+                             'their encodings and tokenizing them, on a '
+                             'pool of threads, for slow filesystems')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='save the index in the memory-mappable binary '
+                             'format instead of pickling it')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='delta + variable-byte compress postings and '
+                             'positions (implies -b)')
+    parser.add_argument('--stats', action='store_true',
+                        help='print phase timings, counters and peak RSS '
+                             'as JSON to stderr')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='save a cProfile of the run to <FILE>')
     return parser.parse_args()
 
 
@@ -65,16 +105,77 @@ def parseInstructions(instrct_list):
     return {}
 
 
-def getFileList(rootdir, instructions):
+def scanDirectory(path):
+    """ ([(file path, (size, mtime))], subdirectories) of one directory"""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # os.walk doesn't follow links either
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif entry.name.endswith('.txt'):
+                        stat = entry.stat()
+                        files.append(
+                            (entry.path, (stat.st_size, stat.st_mtime)))
+                except OSError:
+                    # removed while we looked
+                    pass
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def statTree(rootdir, threads=1):
+    """ path relative to rootdir : (size, mtime) of every .txt file
+
+    Directories of each level are scanned by a pool of threads, stat calls
+    don't hold the GIL. Files come in os.walk order."""
+    scanned = {}
+    pending = [rootdir]
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        while pending:
+            results = list(pool.map(scanDirectory, pending))
+            scanned.update(zip(pending, results))
+            pending = [path for _, subdirs in results for path in subdirs]
+
+    stats = {}
+    stack = [rootdir]
+    while stack:
+        files, subdirs = scanned[stack.pop()]
+        for path, stat in files:
+            stats[path.replace(rootdir+os.sep, '', 1)] = stat
+        stack += reversed(subdirs)
+    return stats
+
+
+def fileHash(file_path, handle=None, data=b''):
+    """ Fast hash of the contents of file_path
+
+    A handle already open on it can be passed with the data read so far."""
+    digest = hashlib.blake2b(data, digest_size=16)
+    with handle or open(file_path, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def getFileList(rootdir, instructions, stats=None):
     ori_filelist = []
-    for subdir, dirs, files in os.walk(rootdir):
-        for file in files:
-            if DEBUG:
-                print(os.path.join(subdir, file))
-            filepath = os.path.join(subdir, file)
+    if stats is not None:
+        ori_filelist = list(stats)
+    else:
+        for subdir, dirs, files in os.walk(rootdir):
+            for file in files:
+                if DEBUG:
+                    print(os.path.join(subdir, file))
+                filepath = os.path.join(subdir, file)
 
-            if filepath.endswith(".txt"):
-                ori_filelist.append(filepath.replace(rootdir+os.sep, ''))
+                if filepath.endswith(".txt"):
+                    ori_filelist.append(filepath.replace(rootdir+os.sep, ''))
 
     ori_filelist.sort(key=lambda x: x.rsplit(os.sep)[-1])
 
@@ -103,46 +204,172 @@ def getFileList(rootdir, instructions):
     return filelist
 
 
-def getFileEncoding(file_path):
-    """ Get the encoding of file_path using chardet package"""
+def detectUTF8(data: bytes, complete: bool):
+    """ chardet-like result when data is ASCII or valid UTF-8, else None
 
+    complete tells whether data is the whole file, otherwise a multibyte
+    character cut at the end of data is not an error."""
+    if data.startswith(codecs.BOM_UTF8):
+        encoding = 'UTF-8-SIG'
+    else:
+        try:
+            data.decode('ascii')
+            return {'encoding': 'ascii', 'confidence': 1.0, 'language': ''}
+        except UnicodeDecodeError:
+            encoding = 'utf-8'
+
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(data, final=complete)
+    except UnicodeDecodeError:
+        return None
+    return {'encoding': encoding, 'confidence': 0.99, 'language': ''}
+
+
+def readEncodingSample(file_path, hashed=False):
+    """ (first MAXSIZE bytes, size, mtime, hash) of file_path, the reads
+    of getFileEncoding. The whole file is only read for the hash, None
+    unless hashed"""
     with open(file_path, 'rb') as f:
-        enc = chardet.detect(f.read(MAXSIZE))
+        data = f.read(MAXSIZE)
+        stat = os.fstat(f.fileno())
+        digest = fileHash(file_path, f, data) if hashed else None
+        return data, stat.st_size, stat.st_mtime, digest
+
+
+def detectEncoding(sample):
+    """ Encoding of a readEncodingSample, using chardet package when it
+    isn't plain ASCII or UTF-8"""
+    data, size, mtime, digest = sample
+
+    enc = detectUTF8(data, size <= MAXSIZE)
+    if enc is None:
+        enc = chardet.detect(data)
+
+    enc['tamanho'] = size
+    enc['modificado'] = mtime
+    enc['hash'] = digest
+
+    if size > MAXSIZE and enc['encoding'] == 'ascii':
+        enc['encoding'] = 'UTF-8'
+        enc['confidence'] = 0.4
+        enc['errors'] = 'mixed'
+    elif size > MAXSIZE and enc['encoding'] == 'utf-8':
+        # only the beginning was checked
+        enc['errors'] = 'mixed'
+    elif enc['confidence'] < .63:
+        enc['errors'] = 'replace'
+    else:
+        enc['errors'] = 'strict'
 
-        size = os.stat(file_path).st_size
+    return enc
 
-        enc['tamanho'] = size
-        enc['modificado'] = os.path.getmtime(file_path)
 
-        if size > MAXSIZE and enc['encoding'] == 'ascii':
-            enc['encoding'] = 'UTF-8'
-            enc['confidence'] = 0.4
-            enc['errors'] = 'mixed'
-        elif enc['confidence'] < .63:
-            enc['errors'] = 'replace'
-        else:
-            enc['errors'] = 'strict'
+def getFileEncoding(file_path, hashed=False):
+    """ Get the encoding of file_path"""
+    return detectEncoding(readEncodingSample(file_path, hashed))
 
-    return enc
+
+def detectEncodings(paths, readers=1, hashed=False):
+    """ getFileEncoding of every path, reading up to readers files ahead"""
+    return [detectEncoding(sample) for sample in
+            mirio.readAhead(partial(readEncodingSample, hashed=hashed),
+                            paths, readers)]
 
 
-def getEncodingDict(filelist, rootdir, instructions, verborragic):
+def loadEncodingCache(rootdir):
+    """ fn : encoding detected by a previous run (see getEncodingDict)"""
+    try:
+        with open('{}/mir.enc'.format(rootdir), 'rb') as handle:
+            return pickle.load(handle)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def saveEncodingCache(rootdir, cache):
+    tmpfn = '{}/mir.enc.tmp'.format(rootdir)
+    with open(tmpfn, 'wb') as handle:
+        pickle.dump(cache, handle)
+    os.replace(tmpfn, '{}/mir.enc'.format(rootdir))
+
+
+def shardList(items, n_shards):
+    """ Split items in (at most) n_shards contiguous slices, keeping order"""
+    size = max(1, -(-len(items) // max(1, n_shards)))
+    return [(i, items[i:i+size]) for i in range(0, len(items), size)]
+
+
+def getEncodingDict(filelist, rootdir, instructions, verborragic, jobs=1,
+                    stats=None, readers=1, hashed=False, digests=None):
+    """ fn : encoding of every file of filelist
+
+    With hashed, each one also gets the hash of its contents: from digests
+    (fn : hash) if it was already computed, else read now."""
     encoding_dic = {}
+    digests = dict(digests or {})
     if verborragic:
         print('\nDebugging information:\n')
 
+    # Files whose size and mtime didn't change since the encoding was
+    # detected keep the cached encoding, but not its hash: the contents may
+    # have changed all the same
+    cache = loadEncodingCache(rootdir)
+    to_detect = []
+    to_hash = []
+    for fn in filelist:
+        if instructions.get(fn) == '@u':
+            continue
+        if stats is not None:
+            size, mtime = stats[fn]
+        else:
+            stat = os.stat(os.path.join(rootdir, fn))
+            size, mtime = stat.st_size, stat.st_mtime
+        cached = cache.get(fn)
+        if (cached is not None and cached['tamanho'] == size
+                and cached['modificado'] == mtime):
+            encoding_dic[fn] = dict(cached, hash=digests.get(fn))
+            if hashed and fn not in digests:
+                to_hash.append(fn)
+        else:
+            to_detect.append(fn)
+
+    if to_hash:
+        with ThreadPoolExecutor(max(jobs, readers)) as pool:
+            for fn, digest in zip(to_hash, pool.map(
+                    fileHash, [os.path.join(rootdir, fn) for fn in to_hash])):
+                encoding_dic[fn]['hash'] = digest
+
+    paths = [os.path.join(rootdir, fn) for fn in to_detect]
+    mirprof.count('encodings_detected', len(paths))
+    if jobs > 1:
+        # each worker reads ahead within its slices
+        with Pool(jobs) as pool:
+            encodings = [
+                enc for part in pool.map(
+                    partial(detectEncodings, readers=readers,
+                            hashed=hashed),
+                    [part for _, part in shardList(paths, jobs*4)])
+                for enc in part]
+    else:
+        encodings = detectEncodings(paths, readers, hashed)
+    detected = dict(zip(to_detect, encodings))
+
+    if detected:
+        cache.update((fn, dict(enc)) for fn, enc in detected.items())
+        saveEncodingCache(rootdir, cache)
+
     for i, fn in enumerate(filelist):
         file_path = os.path.join(rootdir, fn)
-        if instructions.get(fn) == '@u':
+        if fn in detected:
+            encoding_dic[fn] = detected[fn]
+        elif instructions.get(fn) == '@u':
             encoding_dic[fn] = {
                 'encoding': 'utf-8-sig',
                 'confidence': 1,
-                'error': 'strict',
+                'errors': 'strict',
                 'tamanho': os.stat(file_path).st_size,
-                'modificado': os.path.getmtime(file_path)
+                'modificado': os.path.getmtime(file_path),
+                'hash': fileHash(file_path) if hashed else None
             }
-        else:
-            encoding_dic[fn] = getFileEncoding(file_path)
         if verborragic:
             encoding = encoding_dic[fn]['encoding']
             confidence = float(encoding_dic[fn]['confidence'])*100
@@ -161,47 +388,58 @@ def getEncodingDict(filelist, rootdir, instructions, verborragic):
     return encoding_dic
 
 
-def getTokens(fn, rootdir, enc):
+def getTokens(fn, rootdir, enc, data=None):
+    """ data is the contents of the file, if already read"""
     file_path = os.path.join(rootdir, fn)
 
     encoding = enc['encoding']
     confidence = float(enc['confidence'])*100
     myerr = enc['errors']
 
-    n_tokens = 0
-    token_freq = {}
-    token_pos = {}
-
-    with open(file_path, 'r', encoding=encoding, errors=myerr) as handle:
-
-        words_gen = (
-            word.lower()
-            for line in handle
-            for word in resplit.split(line)
-            if word != ''
-        )
-
-        for i, token in enumerate(words_gen):
-            if token != '':
-                if token_freq.get(token) is None:
-                    token_freq[token] = 1
-                    token_pos[token] = [i]
-                else:
-                    token_freq[token] += 1
-                    token_pos[token].append(i)
+    checkpoints = []
+    if data is None:
+        handle = open(file_path, 'r', encoding=encoding, errors=myerr)
+    else:
+        # decoded like the file, so checkpoints seek to the same places
+        handle = io.TextIOWrapper(io.BytesIO(data), encoding=encoding,
+                                  errors=myerr)
+    with handle:
+        token_pos = tokenPositions(handle, CHECKPOINT_SIZE, checkpoints)
 
-    return token_freq, token_pos
+    token_freq = {token: len(pos) for token, pos in token_pos.items()}
+    return token_freq, token_pos, checkpoints
 
 
-def buildReverseIndex(files, rootdir, encoding_dic, index_name, ind_time, verborragic):
-    r_index = {}  # token : list of (fileID, freq, pos_ini)
+def countDocuments(files, encoding_dic, n_tokens):
+    """ Add the indexed files, their bytes and tokens to mirprof counters"""
+    mirprof.count('files', len(files))
+    mirprof.count('bytes_read',
+                  sum(encoding_dic[fn]['tamanho'] for fn in files))
+    mirprof.count('tokens', n_tokens)
+
+
+def indexShard(shard):
+    """ Build the partial index of a contiguous slice of the file list.
+
+    shard is a tuple (first_id, files, rootdir, encoding_dic, readers), doc
+    ids of the partial index start at first_id so shards can be merged
+    directly. Returns the partial index, positions, checkpoints and
+    document lengths."""
+    first_id, files, rootdir, encoding_dic, readers = shard
+
+    r_index = {}  # token : list of (fileID, freq)
     positions = {}  # (token,doc_id) : list of positions of token in doc
-    n_tokens = 0
+    checkpoints = []  # per doc, see mirtok.iterTokensFrom
+    lengths = []  # per doc, number of tokens
 
-    for c, fn in enumerate(files):
+    contents = mirio.readAhead(
+        mirio.readFile, [os.path.join(rootdir, fn) for fn in files], readers)
+    for c, (fn, data) in enumerate(zip(files, contents), first_id):
         enc = encoding_dic[fn]
-        token_freq, token_pos = getTokens(fn, rootdir, enc)
-        n_tokens += sum(token_freq.values())
+        token_freq, token_pos, doc_checkpoints = getTokens(fn, rootdir, enc,
+                                                           data)
+        checkpoints.append(doc_checkpoints)
+        lengths.append(sum(token_freq.values()))
         for t in token_freq.keys():
             positions[(t, c)] = token_pos[t]
             if r_index.get(t) is None:
@@ -209,18 +447,271 @@ def buildReverseIndex(files, rootdir, encoding_dic, index_name, ind_time, verbor
             else:
                 r_index[t].append((c, token_freq[t]))
 
-    # Build position list and update reverse index
-    position_list = []
+    return r_index, positions, checkpoints, lengths
+
+
+def saveIndex(rootdir, index_name, files, r_index, position_list,
+              checkpoints, encoding_dic, ind_time, binary=False,
+              compress=False, stats=None):
+    """ Write every file of index_name, returns the index and position
+    list file names
+
+    In the binary format, r_index None means an mirbin.IndexWriter already
+    wrote the postings, and stats must hold their mirstat table."""
+    picklefn = '{}/{}.pickle'.format(rootdir, index_name)
+    if binary:
+        if r_index is not None:
+            mirbin.writeIndex(rootdir, index_name, r_index, position_list,
+                              compress)
+        picklefn_pl = mirbin.positionsPath(rootdir, index_name)
+        stale = ['{}/{}p.pickle'.format(rootdir, index_name)]
+    else:
+        # positions are mapped in both formats, only binary ones have a .dic
+        stale = mirbin.indexPaths(rootdir, index_name)[:2] + [
+            '{}/{}p.pickle'.format(rootdir, index_name)]
+
+        # Save position list
+        mirbin.writePositions(rootdir, index_name, position_list)
+        picklefn_pl = mirbin.positionsPath(rootdir, index_name)
+
+    # Files left by a previous build in the other format
+    for fn in stale:
+        if os.path.isfile(fn):
+            os.remove(fn)
+
+    if stats is None:
+        stats = mirstat.termStatistics(r_index, len(files))
+    mirstat.saveStats(rootdir, index_name, stats)
+    mirdict.saveDictionary(rootdir, index_name,
+                           mirdict.TermDictionary(stats['df']))
+
+    # Save snippet checkpoints, only read by mirs.py -v
+    with open(checkpointsPath(rootdir, index_name), 'w+b') as picklefile:
+        pickle.dump(checkpoints, picklefile)
+
+    # Save index (only its metadata in the binary format)
+    with open(picklefn, 'w+b') as picklefile:
+        pickler = pickle.Pickler(picklefile)
+        pickler.dump('MIR 2.0b' if binary else 'MIR 2.0')
+        pickler.dump(files)
+        pickler.dump(None if binary else r_index)
+        pickler.dump(encoding_dic)
+        pickler.dump(ind_time)
+
+    return picklefn, picklefn_pl
+
+
+def documentTokens(docs, readers=1):
+    """ (token positions, checkpoints) of each doc of docs, tuples (fn,
+    rootdir, enc), reading up to readers files ahead"""
+    contents = mirio.readAhead(
+        mirio.readFile, [os.path.join(rootdir, fn) for fn, rootdir, _ in docs],
+        readers)
+    for doc, data in zip(docs, contents):
+        _, token_pos, checkpoints = getTokens(*doc, data)
+        yield token_pos, checkpoints
+
 
-    for tok, doc_id in sorted([x for x in positions.keys()]):
-        ind = getIndex(r_index[tok], doc_id)
-        r_index[tok][ind] = (
-            r_index[tok][ind][0],
-            r_index[tok][ind][1],
-            len(position_list)
-        )
+def documentTokensList(docs, readers=1):
+    return list(documentTokens(docs, readers))
 
-        position_list += positions[(tok, doc_id)]
+
+def iterDocumentTokens(files, rootdir, encoding_dic, jobs=1, readers=1):
+    """ documentTokens of every file, in order"""
+    docs = [(fn, rootdir, encoding_dic[fn]) for fn in files]
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            for part in pool.imap(
+                    partial(documentTokensList, readers=readers),
+                    [docs[i:i+16] for i in range(0, len(docs), 16)]):
+                yield from part
+    else:
+        yield from documentTokens(docs, readers)
+
+
+def writeRun(block, run_dir, n_run):
+    """ Save block, token : list of (doc_id, freq, positions), sorted by
+    token. Returns the run's file name"""
+    fn = os.path.join(run_dir, 'run{:05d}'.format(n_run))
+    with open(fn, 'wb') as handle:
+        for tok in sorted(block):
+            pickle.dump((tok, block[tok]), handle, pickle.HIGHEST_PROTOCOL)
+    return fn
+
+
+def readRun(fn):
+    with open(fn, 'rb') as handle:
+        while True:
+            try:
+                yield pickle.load(handle)
+            except EOFError:
+                return
+
+
+def mergeRuns(runs):
+    """ (token, postings) in token order, joining the postings of every run
+
+    Runs hold increasing doc ids and heapq.merge is stable, so the joined
+    postings stay sorted by doc id."""
+    merged = heapq.merge(*(readRun(fn) for fn in runs), key=itemgetter(0))
+    for tok, group in itertools.groupby(merged, key=itemgetter(0)):
+        occ_list = []
+        for _, postings in group:
+            occ_list += postings
+        yield tok, occ_list
+
+
+def writeRuns(files, rootdir, encoding_dic, jobs, budget, run_dir,
+              checkpoints, readers=1):
+    """ Tokenize files into runs of about budget bytes of postings, returns
+    the runs' file names and the number of tokens
+
+    Appends the snippet checkpoints of each document to checkpoints."""
+    n_tokens = 0
+    runs = []
+    block = {}  # token : list of (fileID, freq, positions)
+    used = 0
+    for doc_id, (token_pos, doc_checkpoints) in enumerate(
+            iterDocumentTokens(files, rootdir, encoding_dic, jobs, readers)):
+        checkpoints.append(doc_checkpoints)
+        encoding_dic[files[doc_id]]['tokens'] = sum(
+            len(pos) for pos in token_pos.values())
+        for tok, pos in token_pos.items():
+            postings = block.get(tok)
+            if postings is None:
+                postings = block[tok] = []
+                used += TERM_COST
+            postings.append((doc_id, len(pos), pos))
+            used += POSTING_COST + POSITION_COST * len(pos)
+            n_tokens += len(pos)
+
+        if used >= budget:
+            with mirprof.phase('write_runs'):
+                runs.append(writeRun(block, run_dir, len(runs)))
+            block = {}
+            used = 0
+
+    if block or not runs:
+        with mirprof.phase('write_runs'):
+            runs.append(writeRun(block, run_dir, len(runs)))
+    return runs, n_tokens
+
+
+def buildIndexSPIMI(files, rootdir, encoding_dic, index_name, ind_time,
+                    jobs=1, binary=False, compress=False, memory=256,
+                    readers=1):
+    """ Same index as buildReverseIndex, in bounded memory
+
+    Postings are gathered until they take about memory MB, then written
+    to disk as a run sorted by token. The runs are merged at the end. In
+    the binary format the merge streams into the index files, the pickle
+    format still needs the final index in memory."""
+    checkpoints = []  # doc_id : snippet checkpoints of doc
+
+    with tempfile.TemporaryDirectory(prefix='mirrun', dir=rootdir) as run_dir:
+        with mirprof.phase('tokenize'):
+            runs, n_tokens = writeRuns(files, rootdir, encoding_dic, jobs,
+                                       memory * 2**20, run_dir, checkpoints,
+                                       readers)
+        countDocuments(files, encoding_dic, n_tokens)
+        mirprof.count('runs', len(runs))
+
+        with mirprof.phase('merge_runs'):
+            if binary:
+                r_index = position_list = None
+                term_stats = mirstat.TermStats(len(files))
+                with mirbin.IndexWriter(rootdir, index_name,
+                                        compress) as writer:
+                    for tok, occ_list in mergeRuns(runs):
+                        writer.add(tok, occ_list)
+                        docs, freqs, _ = zip(*occ_list)
+                        term_stats.add(tok, docs, freqs)
+                n_terms, n_positions = writer.n_terms, writer.n_positions
+                stats = term_stats.table()
+            else:
+                r_index = {}
+                position_list = array('I')
+                for tok, occ_list in mergeRuns(runs):
+                    docs, freqs, _ = zip(*occ_list)
+                    offs = []
+                    for _, _, pos in occ_list:
+                        offs.append(len(position_list))
+                        position_list.extend(pos)
+                    r_index[tok] = Postings(docs, freqs, offs)
+                n_terms, n_positions = len(r_index), len(position_list)
+                stats = None
+
+    with mirprof.phase('save'):
+        picklefn, picklefn_pl = saveIndex(
+            rootdir, index_name, files, r_index, position_list, checkpoints,
+            encoding_dic, ind_time, binary, compress, stats)
+
+    print("Os {} documentos foram processados e produziram um total de "
+          "{} tokens, que usaram um vocabulário com {} tokens distintos.\n"
+          "Informações salvas em {} para carga via pickle."
+          .format(len(files), n_tokens, n_terms, picklefn))
+    print("Salvas um total de {} posições na lista geral de posições"
+          "{}".format(n_positions, picklefn_pl))
+    print("Índice construído em {} blocos de até {} MB".format(
+        len(runs), memory))
+    return r_index, n_tokens
+
+
+def buildReverseIndex(files, rootdir, encoding_dic, index_name, ind_time,
+                      verborragic, jobs=1, binary=False, compress=False,
+                      memory=None, readers=1):
+    if memory:
+        return buildIndexSPIMI(files, rootdir, encoding_dic, index_name,
+                               ind_time, jobs, binary, compress, memory,
+                               readers)
+
+    r_index = {}  # token : list of (fileID, freq, pos_ini)
+    positions = {}  # (token,doc_id) : list of positions of token in doc
+    checkpoints = []  # doc_id : snippet checkpoints of doc
+    n_tokens = 0
+
+    with mirprof.phase('tokenize'):
+        if jobs > 1:
+            # More shards than workers, so a few big files don't stall the
+            # pool. Shards come back in order, which keeps doc ids and
+            # postings identical to the serial path.
+            shards = [(first_id, shard, rootdir,
+                       {fn: encoding_dic[fn] for fn in shard}, readers)
+                      for first_id, shard in shardList(files, jobs*4)]
+            with Pool(jobs) as pool:
+                partials = list(pool.imap(indexShard, shards))
+        else:
+            partials = [indexShard((0, files, rootdir, encoding_dic,
+                                    readers))]
+
+        for part_index, part_positions, part_checkpoints, part_lengths \
+                in partials:
+            for fn, n in zip(files[len(checkpoints):], part_lengths):
+                # document length, for BM25 (mirscore.bm25Scores)
+                encoding_dic[fn]['tokens'] = n
+            n_tokens += sum(part_lengths)
+            positions.update(part_positions)
+            checkpoints += part_checkpoints
+            for t, occ_list in part_index.items():
+                if r_index.get(t) is None:
+                    r_index[t] = occ_list
+                else:
+                    r_index[t] += occ_list
+    countDocuments(files, encoding_dic, n_tokens)
+
+    # Build position list and update reverse index. Postings are sorted by
+    # doc id, so walking them in token order visits the (token, doc_id)
+    # pairs in sorted order and each slot is known without a search.
+    position_list = []
+
+    with mirprof.phase('positions'):
+        for tok in sorted(r_index):
+            docs, freqs = zip(*r_index[tok])
+            offs = []
+            for doc_id in docs:
+                offs.append(len(position_list))
+                position_list += positions[(tok, doc_id)]
+            r_index[tok] = Postings(docs, freqs, offs)
 
     if verborragic:
         print('\nFirst 20(or less) positions of position list:')
@@ -231,21 +722,10 @@ def buildReverseIndex(files, rootdir, encoding_dic, index_name, ind_time, verbor
             if i > 20:
                 break
 
-    # Save position list
-    picklefn_pl = '{}/{}p.pickle'.format(args.dir, index_name)
-    with open(picklefn_pl, 'w+b') as picklefile:
-        pickler = pickle.Pickler(picklefile)
-        pickler.dump(position_list)
-
-    # Save index
-    picklefn = '{}/{}.pickle'.format(args.dir, index_name)
-    with open(picklefn, 'w+b') as picklefile:
-        pickler = pickle.Pickler(picklefile)
-        pickler.dump('MIR 2.0')
-        pickler.dump(files)
-        pickler.dump(r_index)
-        pickler.dump(encoding_dic)
-        pickler.dump(ind_time)
+    with mirprof.phase('save'):
+        picklefn, picklefn_pl = saveIndex(
+            rootdir, index_name, files, r_index, position_list, checkpoints,
+            encoding_dic, ind_time, binary, compress)
 
     # Print statements
 
@@ -258,43 +738,107 @@ def buildReverseIndex(files, rootdir, encoding_dic, index_name, ind_time, verbor
     return r_index, n_tokens
 
 
+def buildShardedIndex(args, files, encoding_dic, ind_time):
+    """ Index each of the args.shards slices of files as a shard (see
+    mirshard)"""
+    bounds = mirshard.partition(
+        [encoding_dic[fn]['tamanho'] for fn in files], args.shards)
+    names = []
+    n_tokens = 0
+    for k, (first, end) in enumerate(bounds):
+        name = mirshard.shardName(k)
+        print("\nShard {}: documentos {} a {}".format(name, first, end - 1))
+        shard_files = files[first:end]
+        with mirprof.phase('shard'):
+            _, shard_tokens = buildReverseIndex(
+                shard_files, args.dir,
+                {fn: encoding_dic[fn] for fn in shard_files}, name, ind_time,
+                args.v, args.jobs, args.binary, args.compress, args.memory,
+                args.readers)
+        names.append(name)
+        n_tokens += shard_tokens
+
+    # the segments of an unsharded index are out of date
+    mirseg.resetSegments(args.dir)
+    mirseg.removeSegmentFiles(args.dir, mirseg.BASE)
+    mirshard.saveManifest(args.dir, {
+        'shards': names, 'first': [first for first, _ in bounds],
+        'documents': len(files), 'tokens': n_tokens})
+    print("\nÍndice particionado em {} shards: {}".format(
+        len(names), mirshard.manifestPath(args.dir)))
+
+
+def fileChanged(old_enc, stat, digest=None):
+    """ Whether a file of size and mtime stat (and contents hash digest, if
+    known) differs from the version indexed as old_enc"""
+    size, mtime = stat
+    if old_enc['tamanho'] != size:
+        return True
+    if digest is not None:
+        return digest != old_enc['hash']
+    # Modificado recentemente
+    return old_enc['modificado'] != mtime
+
+
 def buildAuxiliaryIndex(args, current_time):
 
-    old_filelist, old_index, old_encoding_d, _ = unpickle(
-        args.dir, out=False)
+    names = mirseg.segmentNames(args.dir)
+    with mirprof.phase('load'):
+        segments = [(name,) + unpickle(args.dir, out=False,
+                                       ind_name=name)[:3]
+                    for name in names]
+    live, _ = mirseg.liveSources(
+        [(name, seg_fl, mirseg.readRemoved(args.dir, name) if k else ())
+         for k, (name, seg_fl, _, _) in enumerate(segments)])
+    seg_encs = {name: seg_enc for name, _, _, seg_enc in segments}
+    old_encoding_d = {fn: seg_encs[name][fn] for fn, name in live.items()}
 
-    old_size = len(old_filelist)
+    old_size = len(old_encoding_d)
 
     print(
-        "MIR (My Information Retrieval System) de {0}/mir.pickle"
+        "MIR (My Information Retrieval System) de {0}/{3}.pickle"
         " com {1} termos e {2} documentos\nForam carregados os nomes de {2} documentos.\n"
         "Lista atual dos arquivos com extensão .txt encontrados pela sub-árvore"
         " do diretório: {0}"
-        .format(args.dir, len(old_index), old_size))
+        .format(args.dir, len(segments[0][2]), old_size, names[0]))
 
-    filelist = getFileList(args.dir, {})
+    with mirprof.phase('walk'):
+        stats = statTree(args.dir, max(args.jobs, args.readers))
+        filelist = getFileList(args.dir, {}, stats)
 
     new_size = len(filelist)
 
     print("Agora foram encontrados {} documentos.".format(new_size))
 
+    # Same size files are compared by contents with -H
+    hashes = {}
+    if args.hash:
+        same_size = [fn for fn in filelist if fn in old_encoding_d
+                     and old_encoding_d[fn].get('hash') is not None
+                     and old_encoding_d[fn]['tamanho'] == stats[fn][0]]
+        with mirprof.phase('hash'), \
+                ThreadPoolExecutor(max(args.jobs, args.readers)) as pool:
+            hashes = dict(zip(same_size, pool.map(
+                fileHash, [os.path.join(args.dir, fn) for fn in same_size])))
+        mirprof.count('bytes_hashed',
+                      sum(stats[fn][0] for fn in same_size))
+
     # find diferences
     aux_files = []
     rm_files = []
     mod_n = rem_n = new_n = 0
     for fn in filelist:
-        if fn in old_filelist:
-            file_path = os.path.join(args.dir, fn)
-            # Modificado recentemente
-            if old_encoding_d[fn]['modificado'] != os.path.getmtime(file_path):
+        if fn in old_encoding_d:
+            if fileChanged(old_encoding_d[fn], stats[fn], hashes.get(fn)):
                 mod_n += 1
                 aux_files.append(fn)
         else:
             aux_files.append(fn)
             new_n += 1
 
-    for fn in old_filelist:
-        if not fn in filelist:
+    current = set(filelist)
+    for fn in old_encoding_d:
+        if not fn in current:
             rem_n += 1
             rm_files.append(fn)
 
@@ -315,15 +859,134 @@ def buildAuxiliaryIndex(args, current_time):
     for c, fn in enumerate(aux_files):
         print(c, fn)
     print()
-    aux_encoding_dic = getEncodingDict(aux_files, args.dir, {}, args.v)
 
+    if not aux_files and not rm_files:
+        print("Índice em dia, nenhum segmento novo foi criado.")
+        return
+
+    with mirprof.phase('encoding'):
+        aux_encoding_dic = getEncodingDict(
+            aux_files, args.dir, {}, args.v, args.jobs, stats, args.readers,
+            args.hash, hashes)
+
+    name = mirseg.reserveName(args.dir)
     r_index, ntokens = buildReverseIndex(
-        aux_files, args.dir, aux_encoding_dic, 'mira', current_time, args.v)
+        aux_files, args.dir, aux_encoding_dic, name, current_time, args.v,
+        args.jobs, args.binary, args.compress, args.memory, args.readers)
+
+    mirseg.writeRemoved(args.dir, name, rm_files)
+    print("Lista com {} remoções salva em {}".format(
+        rem_n, mirseg.removedPath(args.dir, name)))
+
+    mirseg.appendSegment(args.dir, name)
+
+    names = mirseg.segmentNames(args.dir)
+    if mirseg.mergeCandidates(
+            [mirseg.segmentSize(args.dir, name) for name in names]):
+        startBackgroundMerge(args)
+
+
+def startBackgroundMerge(args):
+    """ Run mir.py -M on args.dir in a detached process"""
+    command = [sys.executable, os.path.abspath(__file__), '-M', args.dir,
+               '-j', str(args.jobs)]
+    if args.compress:
+        command.append('-z')
+    elif args.binary:
+        command.append('-b')
+
+    subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    print("Fusão de segmentos iniciada em segundo plano.")
+
+
+def mergeRange(args, names, first):
+    """ Replace the consecutive segments names by one new segment
+
+    first tells whether names[0] is the base, whose merge needs no list of
+    removals."""
+    rootdir = args.dir
+    loaded = []
+    for name in names:
+        seg_fl, seg_index, seg_enc, seg_time = unpickle(
+            rootdir, out=False, ind_name=name)
+        loaded.append((name, seg_fl, seg_index, seg_enc, seg_time,
+                       loadPositionList(rootdir, name),
+                       loadCheckpoints(rootdir, name),
+                       mirseg.readRemoved(rootdir, name)))
+
+    live, _ = mirseg.liveSources(
+        [(name, seg_fl, rm_files)
+         for name, seg_fl, _, _, _, _, _, rm_files in loaded])
+
+    # doc ids of the merged segment follow the segments' order
+    files = []
+    encoding_dic = {}
+    checkpoints = []
+    new_ids = []
+    for name, seg_fl, _, seg_enc, _, _, seg_chk, _ in loaded:
+        ids = {}
+        for c, fn in enumerate(seg_fl):
+            if live.get(fn) == name:
+                ids[c] = len(files)
+                files.append(fn)
+                encoding_dic[fn] = seg_enc[fn]
+                checkpoints.append(seg_chk[c] if seg_chk else [])
+        new_ids.append(ids)
+
+    r_index = {}
+    position_list = []
+    for tok in sorted(set().union(*(seg[2] for seg in loaded))):
+        occ_list = []
+        for seg, ids in zip(loaded, new_ids):
+            seg_index, pos_list = seg[2], seg[5]
+            for c, freq, ini in seg_index.get(tok, ()):
+                if c in ids:
+                    occ_list.append((ids[c], freq, len(position_list)))
+                    position_list += positionSlice(pos_list, ini, freq)
+        if occ_list:
+            r_index[tok] = Postings.fromList(occ_list)
+
+    new_name = mirseg.reserveName(rootdir)
+    with mirprof.phase('save'):
+        saveIndex(rootdir, new_name, files, r_index, position_list,
+                  checkpoints, encoding_dic, max(seg[4] for seg in loaded),
+                  args.binary, args.compress)
+    if not first:
+        mirseg.writeRemoved(rootdir, new_name, list(dict.fromkeys(
+            fn for seg in loaded for fn in seg[7])))
+
+    if not mirseg.replaceSegments(rootdir, names, new_name):
+        # a full rebuild got there first
+        mirseg.removeSegmentFiles(rootdir, new_name)
+        return
+
+    mirseg.removeSegments(rootdir, names)
+
+    print("Segmentos {} fundidos em {}: {} documentos e {} termos.".format(
+        ', '.join(names), new_name, len(files), len(r_index)))
+
+
+def mergeSegments(args):
+    """ Merge segments while mirseg.mergeCandidates finds some to merge"""
+    with mirseg.locked(args.dir, blocking=False,
+                       lock=mirseg.MERGE_LOCK) as acquired:
+        if not acquired:
+            print("Já há uma fusão de segmentos em andamento em {}."
+                  .format(args.dir))
+            return
+
+        while True:
+            names = mirseg.segmentNames(args.dir)
+            picked = mirseg.mergeCandidates(
+                [mirseg.segmentSize(args.dir, name) for name in names])
+            if not picked:
+                break
+            with mirprof.phase('merge'):
+                mergeRange(args, [names[i] for i in picked], picked[0] == 0)
 
-    with open('{}/mira.rem'.format(args.dir), 'w+') as handle:
-        handle.writelines(['@x {}'.format(fn) for fn in rm_files])
-        handle.write('\n')
-    print("Lista com {} remoções salva em {}/mira.rem".format(rem_n, args.dir))
+    print("Segmentos de {}: {}".format(
+        args.dir, ', '.join(mirseg.segmentNames(args.dir))))
 
 
 if __name__ == "__main__":
@@ -335,7 +998,18 @@ if __name__ == "__main__":
     if args.dir[-1] == '/':
         args.dir = args.dir[:-1]
 
-    if args.auxiliary:
+    args.binary = args.binary or args.compress
+    if args.profile:
+        mirprof.startProfile()
+
+    if (args.merge or args.auxiliary) and mirshard.isSharded(args.dir):
+        print("O índice de {} é particionado em shards, -A e -M não se "
+              "aplicam: reconstrua-o com -S".format(args.dir))
+        exit(1)
+
+    if args.merge:
+        mergeSegments(args)
+    elif args.auxiliary:
         buildAuxiliaryIndex(args, start_time)
     else:
         # deal with instructions
@@ -346,15 +1020,30 @@ if __name__ == "__main__":
         print("Lista de arquivos .txt encontrados na "
               "sub-árvore do diretório: {}".format(args.dir))
 
-        filelist = getFileList(args.dir, instructions)
+        with mirprof.phase('walk'):
+            stats = statTree(args.dir, max(args.jobs, args.readers))
+            filelist = getFileList(args.dir, instructions, stats)
 
         print("Foram encontrados {} documentos.\n".format(len(filelist)))
 
         # Get encoding dict for all files:
 
-        encoding_dic = getEncodingDict(
-            filelist, args.dir, instructions, args.v)
+        with mirprof.phase('encoding'):
+            encoding_dic = getEncodingDict(
+                filelist, args.dir, instructions, args.v, args.jobs, stats,
+                args.readers, args.hash)
 
         # Construct index
-        r_index, ntokens = buildReverseIndex(
-            filelist, args.dir, encoding_dic, 'mir', start_time, args.v)
+        if args.shards:
+            buildShardedIndex(args, filelist, encoding_dic, start_time)
+        else:
+            r_index, ntokens = buildReverseIndex(
+                filelist, args.dir, encoding_dic, mirseg.BASE, start_time,
+                args.v, args.jobs, args.binary, args.compress, args.memory,
+                args.readers)
+
+            # segments and shards of older builds are out of date
+            mirseg.resetSegments(args.dir)
+            mirshard.removeShards(args.dir)
+
+    mirprof.finish(args)
@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# Benchmarks for the MIR indexer and searcher
+#
+#   mirbench.py tokens FILE...           tokenizer throughput
+#   mirbench.py corpus DIR -n N          synthetic corpus
+#   mirbench.py run -n 1000,10000 -o results.json
+#                                        index and query a synthetic corpus
+#                                        of each size, results as JSON
+#   mirbench.py compare OLD.json NEW.json
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+import mirs
+from mir import getFileEncoding
+from mirtok import tokenPositions, tokenPositionsByLine
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+LETTERS = 'abcdefghijlmnoprstuvxz'
+ACCENTED = 'áàâãéêíóôõúç'
+
+
+def getArgs():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for mir.py and mirs.py')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    tok = sub.add_parser('tokens',
+                         help='tokens/sec of the chunked tokenizer against '
+                              'the line by line one (as used by getTokens)')
+    tok.add_argument('files', nargs='+', help='text files to tokenize')
+    tok.add_argument('-n', '--repeat', type=int, default=3,
+                     help='best of <n> runs')
+
+    corpus = sub.add_parser('corpus', help='generate a synthetic corpus')
+    corpus.add_argument('dir', help='directory to be created')
+    addCorpusArgs(corpus)
+    corpus.add_argument('-n', '--docs', type=int, default=1000,
+                        help='number of documents')
+
+    run = sub.add_parser('run',
+                         help='time indexing and querying of synthetic '
+                              'corpora')
+    addCorpusArgs(run)
+    run.add_argument('-n', '--docs', default='1000,10000',
+                     help='comma separated corpus sizes (default 1000,10000)')
+    run.add_argument('-o', '--output',
+                     help='JSON file for the results (default stdout)')
+    run.add_argument('--mir-args', default='',
+                     help='extra arguments for mir.py, e.g. '
+                          '--mir-args="-j 4 -b"')
+    run.add_argument('--queries', type=int, default=10,
+                     help='queries per ranking mode')
+    run.add_argument('--repeat', type=int, default=3,
+                     help='times each query is run (median is reported)')
+    run.add_argument('--workdir',
+                     help='where corpora are generated (default a '
+                          'temporary directory, removed at the end)')
+
+    compare = sub.add_parser('compare',
+                             help='compare two JSON results of run')
+    compare.add_argument('old')
+    compare.add_argument('new')
+
+    return parser.parse_args()
+
+
+def addCorpusArgs(parser):
+    parser.add_argument('--vocabulary', type=int, default=50000,
+                        help='number of distinct words')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='exponent of the Zipf distribution of words')
+    parser.add_argument('--doc-tokens', type=int, default=300,
+                        help='mean number of tokens per document')
+    parser.add_argument('--cp1252', type=float, default=0.3,
+                        help='fraction of documents saved as Windows-1252')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def timeTokenizer(tokenizer, files, encodings, repeat):
+    """ (best time in seconds, tokens) of tokenizing every file"""
+    best = float('inf')
+    for _ in range(repeat):
+        n_tokens = 0
+        start = time.perf_counter()
+        for fn in files:
+            enc = encodings[fn]
+            with open(fn, 'r', encoding=enc['encoding'],
+                      errors=enc['errors']) as handle:
+                token_pos = tokenizer(handle)
+                n_tokens += sum(len(pos) for pos in token_pos.values())
+        best = min(best, time.perf_counter() - start)
+    return best, n_tokens
+
+
+def benchTokens(args):
+    encodings = {fn: getFileEncoding(fn) for fn in args.files}
+
+    for fn in args.files:
+        enc = encodings[fn]
+        with open(fn, 'r', encoding=enc['encoding'],
+                  errors=enc['errors']) as a, \
+             open(fn, 'r', encoding=enc['encoding'],
+                  errors=enc['errors']) as b:
+            if tokenPositionsByLine(a)[1] != tokenPositions(b):
+                print('Tokens diferentes em {}'.format(fn))
+
+    print('{: <12}{: >10}{: >12}{: >14}'.format(
+        'tokenizer', 'tokens', 'segundos', 'tokens/s'))
+    results = {}
+    tokenizers = [('por linha', lambda h: tokenPositionsByLine(h)[1]),
+                  ('em blocos', tokenPositions)]
+    for name, tokenizer in tokenizers:
+        elapsed, n_tokens = timeTokenizer(
+            tokenizer, args.files, encodings, args.repeat)
+        results[name] = n_tokens / elapsed
+        print('{: <12}{: >10}{: >12.3f}{: >14.0f}'.format(
+            name, n_tokens, elapsed, n_tokens / elapsed))
+
+    print('Aceleração: {:.2f}x'.format(
+        results['em blocos'] / results['por linha']))
+
+
+def makeVocabulary(size, rnd):
+    """ size distinct pseudo-words, some with accents (so the encoding of a
+    document matters)"""
+    words = set()
+    while len(words) < size:
+        word = ''.join(rnd.choice(LETTERS)
+                       for _ in range(rnd.randint(2, 10)))
+        if rnd.random() < 0.2:
+            i = rnd.randrange(len(word))
+            word = word[:i] + rnd.choice(ACCENTED) + word[i+1:]
+        words.add(word)
+    return sorted(words)
+
+
+def makeCorpus(rootdir, n_docs, args):
+    """ Write n_docs documents under rootdir, returns
+    (vocabulary ordered by rank, number of tokens written)"""
+    rnd = random.Random(args.seed)
+    vocabulary = makeVocabulary(args.vocabulary, rnd)
+    rnd.shuffle(vocabulary)
+    cum_weights = list(itertools.accumulate(
+        1 / rank**args.zipf for rank in range(1, len(vocabulary) + 1)))
+
+    n_tokens = 0
+    for i in range(n_docs):
+        length = max(1, int(rnd.expovariate(1 / args.doc_tokens)))
+        words = rnd.choices(vocabulary, cum_weights=cum_weights, k=length)
+        n_tokens += length
+
+        lines = []
+        for start in range(0, length, 12):
+            line = ' '.join(words[start:start+12])
+            lines.append(line[0].upper() + line[1:] + '.')
+
+        encoding = 'cp1252' if rnd.random() < args.cp1252 else 'utf-8'
+        file_path = os.path.join(rootdir, 'd{:04d}'.format(i // 1000),
+                                 'doc{:07d}.txt'.format(i))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as handle:
+            handle.write('\n'.join(lines).encode(encoding))
+
+    return vocabulary, n_tokens
+
+
+def benchCorpus(args):
+    vocabulary, n_tokens = makeCorpus(args.dir, args.docs, args)
+    print('{} documentos com {} tokens gerados em {}'.format(
+        args.docs, n_tokens, args.dir))
+
+
+def runIndexer(rootdir, mir_args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(BASEDIR, 'mir.py')] +
+                   mir_args + [rootdir],
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def indexSize(rootdir):
+    return sum(entry.stat().st_size for entry in os.scandir(rootdir)
+               if entry.name.startswith('mir') and entry.is_file())
+
+
+def updateCorpus(rootdir, n_docs, vocabulary, rnd):
+    """ Append to 1% of the documents and remove another 1%, so -A has
+    something to index and mira.rem something to remove"""
+    n_changed = max(1, n_docs // 100)
+    docs = rnd.sample(range(n_docs), min(n_docs, 2 * n_changed))
+    for i in docs[:n_changed]:
+        file_path = os.path.join(rootdir, 'd{:04d}'.format(i // 1000),
+                                 'doc{:07d}.txt'.format(i))
+        with open(file_path, 'a', encoding='utf-8') as handle:
+            handle.write('\n' + ' '.join(rnd.sample(vocabulary[:100], 10)))
+    for i in docs[n_changed:]:
+        os.remove(os.path.join(rootdir, 'd{:04d}'.format(i // 1000),
+                               'doc{:07d}.txt'.format(i)))
+
+
+def makeQueries(vocabulary, n_queries, rnd):
+    """ Two and three term queries mixing frequent and mid-frequency words"""
+    frequent = vocabulary[:50]
+    medium = vocabulary[50:500] or frequent
+    queries = []
+    for i in range(n_queries):
+        terms = [rnd.choice(frequent), rnd.choice(medium)]
+        if i % 2:
+            terms.append(rnd.choice(frequent))
+        queries.append(terms)
+    return queries
+
+
+def timeQuery(argv, filelist, r_index, repeat):
+    """ Median latency of runQuery, or the error it raised"""
+    times = []
+    for _ in range(repeat):
+        args = mirs.getArgs(argv)
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()):
+                mirs.runQuery(args, filelist, r_index)
+        except (Exception, SystemExit) as e:
+            return {'error': '{}: {}'.format(type(e).__name__, e)}
+        times.append(time.perf_counter() - start)
+    return {'seconds': statistics.median(times)}
+
+
+def benchSize(workdir, n_docs, args):
+    rootdir = os.path.join(workdir, 'corpus{}'.format(n_docs))
+    shutil.rmtree(rootdir, ignore_errors=True)
+    os.makedirs(rootdir)
+    rnd = random.Random(args.seed + n_docs)
+    mir_args = args.mir_args.split()
+
+    print('{} documentos...'.format(n_docs), file=sys.stderr)
+    vocabulary, n_tokens = makeCorpus(rootdir, n_docs, args)
+
+    result = {'docs': n_docs, 'tokens': n_tokens}
+    result['index_seconds'] = runIndexer(rootdir, mir_args)
+    result['docs_per_second'] = n_docs / result['index_seconds']
+    result['tokens_per_second'] = n_tokens / result['index_seconds']
+    result['index_bytes'] = indexSize(rootdir)
+
+    updateCorpus(rootdir, n_docs, vocabulary, rnd)
+    result['aux_index_seconds'] = runIndexer(rootdir, mir_args + ['-A'])
+    result['total_index_bytes'] = indexSize(rootdir)
+
+    load_args = mirs.getArgs([rootdir])
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        filelist, r_index = mirs.loadCombinedIndex(load_args)
+    result['load_seconds'] = time.perf_counter() - start
+
+    queries = makeQueries(vocabulary, args.queries, rnd)
+    result['queries'] = {}
+    for mode in range(5):
+        latencies = [timeQuery(['-o', str(mode), rootdir] + terms,
+                               filelist, r_index, args.repeat)
+                     for terms in queries]
+        ok = [lat['seconds'] for lat in latencies if 'seconds' in lat]
+        result['queries'][str(mode)] = {
+            'median_seconds': statistics.median(ok) if ok else None,
+            'max_seconds': max(ok) if ok else None,
+            'errors': sorted({lat['error'] for lat in latencies
+                              if 'error' in lat})
+        }
+
+    shutil.rmtree(rootdir)
+    return result
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASEDIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchRun(args):
+    sizes = [int(n) for n in args.docs.split(',')]
+    report = {
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'mir_args': args.mir_args,
+        'params': {'vocabulary': args.vocabulary, 'zipf': args.zipf,
+                   'doc_tokens': args.doc_tokens, 'cp1252': args.cp1252,
+                   'seed': args.seed, 'queries': args.queries},
+        'results': []
+    }
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mirbench')
+    try:
+        for n_docs in sizes:
+            report['results'].append(benchSize(workdir, n_docs, args))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+    else:
+        print(output)
+
+
+def flatten(result, prefix=''):
+    """ metric name : value, for the numeric entries of a run result"""
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '{}{}.'.format(prefix, key)))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def benchCompare(args):
+    with open(args.old) as handle:
+        old = json.load(handle)
+    with open(args.new) as handle:
+        new = json.load(handle)
+
+    print('{} -> {}'.format(old.get('commit'), new.get('commit')))
+    old_results = {r['docs']: flatten(r) for r in old['results']}
+    for result in new['results']:
+        before = old_results.get(result['docs'])
+        if before is None:
+            continue
+        print('\n{} documentos'.format(result['docs']))
+        for metric, value in flatten(result).items():
+            if metric in ('docs', 'tokens') or not before.get(metric):
+                continue
+            print('{: <32}{: >14.4g}{: >14.4g}{: >9.2f}x'.format(
+                metric, before[metric], value, value / before[metric]))
+
+
+if __name__ == "__main__":
+
+    args = getArgs()
+
+    if args.bench == 'tokens':
+        benchTokens(args)
+    elif args.bench == 'corpus':
+        benchCorpus(args)
+    elif args.bench == 'run':
+        benchRun(args)
+    elif args.bench == 'compare':
+        benchCompare(args)
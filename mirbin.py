@@ -0,0 +1,283 @@
+#!/usr/bin/python
+# Memory-mappable on-disk layout of the reverse index
+#
+#   <name>.dic   sorted term dictionary
+#                header  (magic, n_terms, flags, n_positions)
+#                entries n_terms x (term_off, post_off, df, term_len)
+#                blob    utf-8 terms, in the same (sorted) order
+#   <name>.pst   postings, unsigned int triples (doc_id, freq, pos_ini)
+#   <name>p.pos  flat position list, unsigned ints
+#
+# With the COMPRESSED flag, .pst and p.pos hold mircodec varint streams
+# instead: post_off and pos_ini are byte offsets into them.
+#
+# The pickle format keeps its postings in <name>.pickle but also writes the
+# positions to an uncompressed p.pos, with no .dic. The positions of a term
+# are contiguous, so proximity queries only page in the slices they read.
+#
+# Integers are written in native byte order. Nothing is read up front:
+# lookups binary search the entries and decode only the postings asked for.
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import MutableMapping
+
+import mircodec
+from mircache import POSTINGS_SIZE, LRUCache
+from mirpost import Postings
+
+MAGIC = b'MIRD'
+HEADER = struct.Struct('=4sIIQ')
+ENTRY = struct.Struct('=QQII')
+COMPRESSED = 1
+
+
+class IndexWriter:
+    """ Writes the binary layout one term at a time, in sorted term order
+
+    Postings and positions go straight to their files, only the term
+    dictionary is kept in memory until close()."""
+
+    def __init__(self, rootdir, index_name, compress=False):
+        self.rootdir = rootdir
+        self.index_name = index_name
+        self.compress = compress
+
+        self.entries = bytearray()
+        self.blob = bytearray()
+        self.n_terms = 0
+        self.n_positions = 0
+        # written so far: entries/positions, or bytes when compressed
+        self.post_off = 0
+        self.pos_off = 0
+
+        self.postings = open('{}/{}.pst'.format(rootdir, index_name), 'wb')
+        self.positions = open(positionsPath(rootdir, index_name), 'wb')
+
+    def add(self, tok, occ_list):
+        """ occ_list is a list of (doc_id, freq, positions) sorted by doc"""
+        if self.compress:
+            postings = bytearray()
+            positions = bytearray()
+            packed = []
+            for doc_id, freq, pos in occ_list:
+                packed.append((doc_id, freq, self.pos_off + len(positions)))
+                mircodec.encodeDeltas(pos, positions)
+            mircodec.encodePostings(packed, postings)
+            post_off = self.post_off
+            self.post_off += len(postings)
+            self.pos_off += len(positions)
+        else:
+            postings = array('I')
+            positions = array('I')
+            for doc_id, freq, pos in occ_list:
+                postings.extend((doc_id, freq, self.pos_off + len(positions)))
+                positions.extend(pos)
+            post_off = self.post_off
+            self.post_off += len(occ_list)
+            self.pos_off += len(positions)
+
+        self.postings.write(postings)
+        self.positions.write(positions)
+        self.n_positions += sum(freq for _, freq, _ in occ_list)
+
+        encoded = tok.encode('utf-8')
+        self.entries += ENTRY.pack(len(self.blob), post_off,
+                                   len(occ_list), len(encoded))
+        self.blob += encoded
+        self.n_terms += 1
+
+    def close(self):
+        self.postings.close()
+        self.positions.close()
+        with open('{}/{}.dic'.format(self.rootdir, self.index_name),
+                  'wb') as handle:
+            handle.write(HEADER.pack(MAGIC, self.n_terms,
+                                     COMPRESSED if self.compress else 0,
+                                     self.n_positions))
+            handle.write(self.entries)
+            handle.write(self.blob)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def writeIndex(rootdir, index_name, r_index, position_list, compress=False):
+    """ Save r_index and position_list in the binary layout"""
+    with IndexWriter(rootdir, index_name, compress) as writer:
+        for tok in sorted(r_index):
+            writer.add(tok, [(doc_id, freq, position_list[ini:ini+freq])
+                             for doc_id, freq, ini in r_index[tok]])
+
+
+def writePositions(rootdir, index_name, position_list):
+    """ Save the positions of a pickle format index as a flat p.pos
+
+    Written aside and renamed, so readers still mapping the old file keep
+    their pages."""
+    path = positionsPath(rootdir, index_name)
+    if not isinstance(position_list, array):
+        position_list = array('I', position_list)
+    with open(path + '.tmp', 'wb') as handle:
+        position_list.tofile(handle)
+    os.replace(path + '.tmp', path)
+
+
+def positionsPath(rootdir, index_name):
+    return '{}/{}p.pos'.format(rootdir, index_name)
+
+
+def indexPaths(rootdir, index_name):
+    return ['{}/{}.dic'.format(rootdir, index_name),
+            '{}/{}.pst'.format(rootdir, index_name),
+            positionsPath(rootdir, index_name)]
+
+
+def mapFile(path):
+    """ Read-only mmap of path (empty files can't be mapped)"""
+    with open(path, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def readHeader(rootdir, index_name):
+    """ (n_terms, flags, n_positions) of the index"""
+    with open('{}/{}.dic'.format(rootdir, index_name), 'rb') as handle:
+        magic, n_terms, flags, n_positions = HEADER.unpack(
+            handle.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('{}/{}.dic is not a MIR dictionary'
+                         .format(rootdir, index_name))
+    return n_terms, flags, n_positions
+
+
+def loadPositions(rootdir, index_name):
+    """ Position list backed by the mmap
+
+    Indexable like a list, or a mircodec.PackedPositions when the index is
+    compressed. Those of the pickle format (no .dic) never are."""
+    flags = n_positions = 0
+    if os.path.isfile('{}/{}.dic'.format(rootdir, index_name)):
+        _, flags, n_positions = readHeader(rootdir, index_name)
+    buf = mapFile(positionsPath(rootdir, index_name))
+    if flags & COMPRESSED:
+        return mircodec.PackedPositions(buf, n_positions)
+    return memoryview(buf).cast('I')
+
+
+class MappedIndex(MutableMapping):
+    """ token : list of (fileID, freq, pos_ini), read lazily from disk
+
+    Assignments (e.g. merging the auxiliary index) are kept in memory on
+    top of the mapped data, and excluded doc ids are filtered on read."""
+
+    def __init__(self, rootdir, index_name):
+        self.n_terms, flags, _ = readHeader(rootdir, index_name)
+        self.compressed = bool(flags & COMPRESSED)
+
+        self.dic = mapFile('{}/{}.dic'.format(rootdir, index_name))
+        self.postings = mapFile('{}/{}.pst'.format(rootdir, index_name))
+        if not self.compressed:
+            self.postings = memoryview(self.postings).cast('I')
+
+        self.blob_start = HEADER.size + self.n_terms * ENTRY.size
+
+        self.overlay = {}
+        self.excluded = set()
+        # term id : decoded postings, without the excluded doc ids
+        self.cache = LRUCache(POSTINGS_SIZE, 'postings')
+
+    def entry(self, i):
+        return ENTRY.unpack_from(self.dic, HEADER.size + i * ENTRY.size)
+
+    def term(self, i):
+        term_off, _, _, term_len = self.entry(i)
+        start = self.blob_start + term_off
+        return bytes(self.dic[start:start + term_len]).decode('utf-8')
+
+    def find(self, tok):
+        """ Binary search tok in the dictionary, -1 if absent"""
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < tok:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self.term(lo) == tok:
+            return lo
+        return -1
+
+    def iterOccurrences(self, i):
+        _, post_off, df, _ = self.entry(i)
+        if self.compressed:
+            return mircodec.iterPostings(self.postings, post_off, df)
+        p = self.postings[3*post_off:3*(post_off + df)]
+        return ((p[j], p[j+1], p[j+2]) for j in range(0, len(p), 3))
+
+    def occurrences(self, i):
+        occ_list = self.cache.get(i)
+        if occ_list is not None:
+            return occ_list
+
+        _, post_off, df, _ = self.entry(i)
+        if self.compressed:
+            occ_list = Postings.fromList(
+                list(mircodec.iterPostings(self.postings, post_off, df)))
+        else:
+            occ_list = Postings.fromFlat(
+                self.postings[3*post_off:3*(post_off + df)])
+        occ_list = occ_list.without(self.excluded)
+        self.cache.put(i, occ_list)
+        return occ_list
+
+    def exclude(self, doc_ids):
+        """ Hide doc_ids from every postings list"""
+        self.excluded.update(doc_ids)
+        self.cache.clear()
+
+    def __getitem__(self, tok):
+        if tok in self.overlay:
+            if self.overlay[tok] is None:
+                raise KeyError(tok)
+            return self.overlay[tok]
+        i = self.find(tok)
+        if i < 0:
+            raise KeyError(tok)
+        return self.occurrences(i)
+
+    def __setitem__(self, tok, occ_list):
+        self.overlay[tok] = occ_list
+
+    def __delitem__(self, tok):
+        self[tok]
+        self.overlay[tok] = None
+
+    def __contains__(self, tok):
+        if tok in self.overlay:
+            return self.overlay[tok] is not None
+        return self.find(tok) >= 0
+
+    def __iter__(self):
+        for i in range(self.n_terms):
+            tok = self.term(i)
+            if self.overlay.get(tok, True) is not None:
+                yield tok
+        for tok, occ_list in self.overlay.items():
+            if occ_list is not None and self.find(tok) < 0:
+                yield tok
+
+    def __len__(self):
+        size = self.n_terms
+        for tok, occ_list in self.overlay.items():
+            found = self.find(tok) >= 0
+            if occ_list is None and found:
+                size -= 1
+            elif occ_list is not None and not found:
+                size += 1
+        return size
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# Bounded least recently used caches
+#
+# Keys must change whenever what they stand for does: cached segments and
+# query results are keyed by the index files' mtimes and sizes (see
+# mirs.indexGeneration), so rewriting the index makes them unreachable and
+# they are evicted in time. Hits and misses are mirprof counters.
+from collections import OrderedDict
+
+import mirprof
+
+# decoded postings lists of a binary index (mirbin.MappedIndex)
+POSTINGS_SIZE = 4096
+# decoded position slices of a compressed index
+POSITIONS_SIZE = 1 << 16
+# output of whole queries (mirs.cachedQuery)
+RESULTS_SIZE = 512
+# unpickled segments (mirs.readSegment)
+SEGMENTS_SIZE = 16
+
+
+class LRUCache:
+    """ At most maxsize entries, the least recently used is evicted first"""
+
+    def __init__(self, maxsize, name):
+        self.maxsize = maxsize
+        self.name = name
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            mirprof.count('cache.{}.misses'.format(self.name))
+            return default
+        self.entries.move_to_end(key)
+        mirprof.count('cache.{}.hits'.format(self.name))
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# Delta + variable-byte codec for postings and positions
+#
+# Each integer is written 7 bits at a time, least significant group first,
+# with the high bit set on every byte but the last. Increasing sequences
+# (doc ids of a postings list, positions of a token in a document) are
+# stored as the differences between consecutive values, which keeps most
+# of them in a single byte.
+from mircache import POSITIONS_SIZE, LRUCache
+
+
+def encodeVarint(value, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decodeVarint(buf, offset):
+    """ Returns (value, offset of the next varint)"""
+    value = shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encodeDeltas(values, out: bytearray):
+    """ Append the increasing sequence values as varint gaps"""
+    last = 0
+    for v in values:
+        encodeVarint(v - last, out)
+        last = v
+
+
+def iterDeltas(buf, offset, count):
+    """ Walk count gaps written by encodeDeltas from offset"""
+    last = 0
+    for _ in range(count):
+        gap, offset = decodeVarint(buf, offset)
+        last += gap
+        yield last
+
+
+def decodeDeltas(buf, offset, count):
+    return list(iterDeltas(buf, offset, count))
+
+
+def encodePostings(occ_list, out: bytearray):
+    """ Append a postings list of (doc_id, freq, pos_off) sorted by doc_id
+
+    doc_id and pos_off are both increasing along a list, so both are gaps."""
+    last_doc = last_off = 0
+    for doc_id, freq, pos_off in occ_list:
+        encodeVarint(doc_id - last_doc, out)
+        encodeVarint(freq, out)
+        encodeVarint(pos_off - last_off, out)
+        last_doc, last_off = doc_id, pos_off
+
+
+def iterPostings(buf, offset, count):
+    """ Walk one postings list of count entries, starting at offset"""
+    doc_id = pos_off = 0
+    for _ in range(count):
+        gap, offset = decodeVarint(buf, offset)
+        doc_id += gap
+        freq, offset = decodeVarint(buf, offset)
+        gap, offset = decodeVarint(buf, offset)
+        pos_off += gap
+        yield doc_id, freq, pos_off
+
+
+def decodePostings(buf, offset, count):
+    return list(iterPostings(buf, offset, count))
+
+
+class PackedPositions:
+    """ Compressed position lists, addressed by (byte offset, count)
+
+    This is what the pos_ini of a compressed index points to."""
+
+    def __init__(self, buf, n_positions):
+        self.buf = buf
+        self.n_positions = n_positions
+        self.cache = LRUCache(POSITIONS_SIZE, 'positions')
+
+    def read(self, pos_off, freq):
+        positions = self.cache.get(pos_off)
+        if positions is None:
+            positions = decodeDeltas(self.buf, pos_off, freq)
+            self.cache.put(pos_off, positions)
+        return positions
+
+    def __len__(self):
+        return self.n_positions
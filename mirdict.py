@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# Term dictionary of each segment, in <segment>t.pickle
+#
+# The sorted vocabulary plus a trigram index (trigram : ids of the terms
+# containing it). A prefix is a range of the sorted terms, and a regex or
+# wildcard pattern only needs to be tested against the terms holding every
+# trigram of the text each of its matches must contain.
+import fnmatch
+import pickle
+import re
+from array import array
+from bisect import bisect_left
+
+import mirseg
+
+# Patterns in a query: glob wildcards, or a regex between slashes
+GLOB_CHARS = '*?['
+
+
+class TermDictionary:
+    __slots__ = ('terms', 'grams')
+
+    def __init__(self, terms=(), index_grams=True):
+        """ Without index_grams, only prefixes narrow the search"""
+        self.terms = sorted(terms)
+        self.grams = None
+        if not index_grams:
+            return
+
+        grams = {}
+        for term_id, term in enumerate(self.terms):
+            for gram in set(trigrams(term)):
+                ids = grams.get(gram)
+                if ids is None:
+                    grams[gram] = [term_id]
+                else:
+                    ids.append(term_id)
+        self.grams = {gram: array('I', ids) for gram, ids in grams.items()}
+
+    def __len__(self):
+        return len(self.terms)
+
+    def prefixRange(self, prefix):
+        """ range of the ids of the terms starting with prefix"""
+        lo = bisect_left(self.terms, prefix)
+        # no term has a character above the last code point
+        hi = bisect_left(self.terms, prefix + '\U0010ffff', lo)
+        return range(lo, hi)
+
+    def candidates(self, prefix, literals):
+        """ Ids of the terms starting with prefix and containing every
+        trigram of literals, in increasing order"""
+        ids = self.prefixRange(prefix) if prefix else None
+        gram_ids = []
+        if self.grams is not None:
+            gram_ids = [self.grams.get(gram, ())
+                        for text in literals for gram in trigrams(text)]
+        if gram_ids:
+            gram_ids.sort(key=len)
+            common = set(gram_ids[0])
+            for other in gram_ids[1:]:
+                if not common:
+                    break
+                common.intersection_update(other)
+            if ids is not None:
+                common = {term_id for term_id in common if term_id in ids}
+            return sorted(common)
+        if ids is not None:
+            return ids
+        return range(len(self.terms))
+
+    def search(self, regex):
+        """ Terms where the compiled regex finds a match"""
+        prefix, literals = regexLiterals(regex)
+        return [self.terms[term_id]
+                for term_id in self.candidates(prefix, literals)
+                if regex.search(self.terms[term_id])]
+
+    def glob(self, pattern):
+        """ Terms matching the wildcards of pattern (*, ? and [...])"""
+        literals = re.split(r'[*?]|\[[^\]]*\]?', pattern)
+        prefix = literals[0]
+        return [self.terms[term_id]
+                for term_id in self.candidates(prefix, literals)
+                if fnmatch.fnmatchcase(self.terms[term_id], pattern)]
+
+
+def trigrams(text):
+    return (text[i:i+3] for i in range(len(text) - 2))
+
+
+def classEnd(pattern, i):
+    """ Index of the ']' closing the class opened at pattern[i]"""
+    i += 1
+    if pattern[i:i+1] == '^':
+        i += 1
+    if pattern[i:i+1] == ']':
+        # a ']' right after '[' or '[^' is a member
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i
+
+
+def regexLiterals(regex):
+    """ (prefix, literals) of a compiled regex: text its matches must start
+    with ('' if unknown) and runs of text they all contain
+
+    Only plain characters outside groups and classes are considered, so
+    the answer is conservative: ('', []) means any term may match."""
+    if regex.flags & (re.IGNORECASE | re.VERBOSE):
+        return '', []
+    pattern = regex.pattern
+    if isinstance(pattern, bytes) or '|' in pattern:
+        return '', []
+
+    literals = []
+    run = ''
+    anchored = pattern.startswith('^')
+    i = 1 if anchored else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c in '*?{':
+            # the previous character is optional
+            run = run[:-1]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            i = classEnd(pattern, i)
+        elif c == '(':
+            depth = 1
+            while i + 1 < len(pattern) and depth:
+                i += 1
+                if pattern[i] == '\\':
+                    i += 1
+                elif pattern[i] == '[':
+                    i = classEnd(pattern, i)
+                elif pattern[i] in '()':
+                    depth += 1 if pattern[i] == '(' else -1
+        elif c == '{':
+            i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif c not in '.^$*?+':
+            run += c
+            i += 1
+            continue
+
+        literals.append(run)
+        run = ''
+        i += 1
+    literals.append(run)
+
+    prefix = literals[0] if anchored else ''
+    return prefix, [text for text in literals if text]
+
+
+def isRegex(tok):
+    return len(tok) > 2 and tok[0] == tok[-1] == '/'
+
+
+def isPattern(tok):
+    """ Whether a query term is a pattern to be expanded"""
+    return isRegex(tok) or any(c in tok for c in GLOB_CHARS)
+
+
+def searchTerms(dictionaries, regex):
+    """ Set of the terms of any of dictionaries matched by regex"""
+    return set().union(*(d.search(regex) for d in dictionaries))
+
+
+def expandPattern(dictionaries, tok):
+    """ Sorted terms of any of dictionaries matching the query pattern tok"""
+    if isRegex(tok):
+        return sorted(searchTerms(dictionaries, re.compile(tok[1:-1])))
+    return sorted(set().union(*(d.glob(tok) for d in dictionaries)))
+
+
+def dictionaryPath(rootdir, name):
+    return '{}/{}t.pickle'.format(rootdir, name)
+
+
+def saveDictionary(rootdir, name, term_dict):
+    with open(dictionaryPath(rootdir, name), 'w+b') as handle:
+        pickle.dump(term_dict, handle, pickle.HIGHEST_PROTOCOL)
+
+
+def loadDictionary(rootdir, name):
+    """ TermDictionary of segment name, None for indexes without it"""
+    try:
+        with open(dictionaryPath(rootdir, name), 'rb') as handle:
+            return pickle.load(handle)
+    except FileNotFoundError:
+        return None
+
+
+def loadDictionaries(rootdir, names=None):
+    """ TermDictionary of every segment (or of names), None if some
+    segment has none"""
+    if names is None:
+        names = mirseg.segmentNames(rootdir)
+    dictionaries = [loadDictionary(rootdir, name) for name in names]
+    if None in dictionaries:
+        return None
+    return dictionaries
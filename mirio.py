@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# Read-ahead of the files to index (mir.py --readers)
+#
+# On network or otherwise slow filesystems the indexer mostly waits for
+# reads, one file at a time. readAhead keeps a few reads in flight on a
+# pool of threads (reading and hashing release the GIL) ahead of the
+# stage consuming them, encoding detection or tokenization. It stops
+# issuing reads while that many results wait to be consumed, which bounds
+# the memory they take, and hands them over in input order, so the index
+# is the same whatever the number of readers.
+#
+# Each process reads its own files: the -j workers read ahead of their own
+# tokenizer instead of being sent the contents.
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+# bigger files are streamed from disk by their consumer instead
+MAX_READ = 1 << 24
+
+
+def readAhead(function, items, in_flight=1):
+    """ function(item) of every item, in order, with up to in_flight of
+    them running or done but not yet consumed"""
+    if in_flight <= 1:
+        yield from map(function, items)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(in_flight) as pool:
+        pending = deque(pool.submit(function, item)
+                        for item in islice(items, in_flight))
+        while pending:
+            result = pending.popleft().result()
+            for item in islice(items, 1):
+                pending.append(pool.submit(function, item))
+            yield result
+
+
+def readFile(path, max_size=MAX_READ):
+    """ Contents of path, None if it has more than max_size bytes"""
+    with open(path, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size > max_size:
+            return None
+        return handle.read()
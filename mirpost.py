@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# Compact postings lists
+#
+# A postings list reads like the list of (doc_id, freq, pos_ini) tuples it
+# replaces, but keeps each field in its own array('I'): 12 bytes a posting
+# instead of a tuple and three int objects. Filtering, remapping and merging
+# work on whole arrays.
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+# up to this many entries, merge inserts them instead of sorting everything
+MERGE_INSERTS = 32
+
+
+class Postings:
+    """ (doc_id, freq, pos_ini) sorted by doc_id, in three parallel arrays"""
+    __slots__ = ('docs', 'freqs', 'offs')
+
+    def __init__(self, docs=(), freqs=(), offs=()):
+        self.docs = array('I', docs)
+        self.freqs = array('I', freqs)
+        self.offs = array('I', offs)
+
+    @classmethod
+    def fromList(cls, occ_list):
+        if isinstance(occ_list, cls):
+            return occ_list
+        if not occ_list:
+            return cls()
+        return cls(*zip(*occ_list))
+
+    @classmethod
+    def fromFlat(cls, buf):
+        """ Postings from a buffer of interleaved triples (mirbin's .pst)"""
+        flat = array('I')
+        flat.frombytes(memoryview(buf).cast('B'))
+        return cls(flat[0::3], flat[1::3], flat[2::3])
+
+    @classmethod
+    def fromBytes(cls, buf):
+        """ Inverse of toBytes"""
+        flat = array('I')
+        flat.frombytes(buf)
+        n = len(flat) // 3
+        postings = cls.__new__(cls)
+        postings.docs = flat[:n]
+        postings.freqs = flat[n:2*n]
+        postings.offs = flat[2*n:]
+        return postings
+
+    def toBytes(self):
+        return self.docs.tobytes() + self.freqs.tobytes() + self.offs.tobytes()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return zip(self.docs, self.freqs, self.offs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Postings(self.docs[i], self.freqs[i], self.offs[i])
+        return self.docs[i], self.freqs[i], self.offs[i]
+
+    def __eq__(self, other):
+        if isinstance(other, Postings):
+            return (self.docs == other.docs and self.freqs == other.freqs
+                    and self.offs == other.offs)
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'Postings({})'.format(list(self))
+
+    def __reduce__(self):
+        # a single bytes object is much faster to unpickle than 3 arrays
+        return Postings.fromBytes, (self.toBytes(),)
+
+    @classmethod
+    def union(cls, occ_lists):
+        """ Postings of the documents in any of occ_lists, with their
+        frequencies added up. Positions are not kept: pos_ini is 0"""
+        freqs = {}
+        for occ_list in occ_lists:
+            for doc_id, freq, _ in occ_list:
+                freqs[doc_id] = freqs.get(doc_id, 0) + freq
+        docs = sorted(freqs)
+        return cls(docs, map(freqs.__getitem__, docs), [0] * len(docs))
+
+    def find(self, doc_id):
+        """ Index of doc_id, -1 if absent"""
+        i = bisect_left(self.docs, doc_id)
+        if i < len(self.docs) and self.docs[i] == doc_id:
+            return i
+        return -1
+
+    def select(self, mask):
+        """ Postings whose entry in the booleans mask is true"""
+        return Postings(compress(self.docs, mask), compress(self.freqs, mask),
+                        compress(self.offs, mask))
+
+    def without(self, doc_ids):
+        """ Postings of the documents not in the set doc_ids"""
+        if doc_ids.isdisjoint(self.docs):
+            return self
+        return self.select([d not in doc_ids for d in self.docs])
+
+    def only(self, doc_ids):
+        """ Postings of the documents in the set doc_ids"""
+        return self.select([d in doc_ids for d in self.docs])
+
+    def remap(self, mapping, ordered=True):
+        """ Same postings with doc ids translated through mapping[doc_id]
+
+        ordered tells that mapping keeps doc ids increasing, otherwise the
+        postings are sorted again."""
+        docs = map(mapping.__getitem__, self.docs)
+        if ordered:
+            return Postings(docs, self.freqs, self.offs)
+        return Postings(*zip(*sorted(zip(docs, self.freqs, self.offs))))
+
+    def merge(self, other):
+        """ Union of both lists, other's entry wins for a doc in both"""
+        if not other:
+            return self
+        base = self.without(set(other.docs))
+        if not base or base.docs[-1] < other.docs[0]:
+            # other holds only newer documents: just append
+            return Postings(base.docs + other.docs, base.freqs + other.freqs,
+                            base.offs + other.offs)
+        if len(other) > MERGE_INSERTS:
+            return Postings(*zip(*sorted(zip(
+                base.docs + other.docs, base.freqs + other.freqs,
+                base.offs + other.offs))))
+
+        # a few documents replaced in place
+        merged = base[:]
+        for doc_id, freq, off in other:
+            i = bisect_left(merged.docs, doc_id)
+            merged.docs.insert(i, doc_id)
+            merged.freqs.insert(i, freq)
+            merged.offs.insert(i, off)
+        return merged
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# Phase timings and counters of mir.py and mirs.py runs (--stats/--profile)
+#
+# Code wraps its phases in `with phase('name'):` and adds to counters with
+# count('name', n). Phases may nest, each one reports its own wall time.
+# Work done in worker processes is timed by the phase that waits for it.
+import cProfile
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+phases = {}  # name : [seconds, calls]
+counters = {}  # name : total
+_start = time.perf_counter()
+_profile = None
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = phases.get(name)
+        if entry is None:
+            entry = phases[name] = [0.0, 0]
+        entry[0] += time.perf_counter() - start
+        entry[1] += 1
+
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+
+def startProfile():
+    """ Capture a cProfile of the rest of the run"""
+    global _profile
+    _profile = cProfile.Profile()
+    _profile.enable()
+
+
+def report():
+    """ Phases, counters and resource usage so far, as a dict"""
+    seconds = time.perf_counter() - _start
+    rates = {}
+    if 'tokens' in counters and 'tokenize' in phases:
+        rates['tokens_per_second'] = (
+            counters['tokens'] / max(phases['tokenize'][0], 1e-9))
+    if 'bytes_read' in counters:
+        rates['bytes_per_second'] = counters['bytes_read'] / seconds
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'seconds': seconds,
+        'phases': {name: {'seconds': s, 'calls': n}
+                   for name, (s, n) in phases.items()},
+        'counters': counters,
+        'rates': rates,
+        # kilobytes on Linux; children are the -j workers
+        'peak_rss_kb': own.ru_maxrss,
+        'children_peak_rss_kb': children.ru_maxrss,
+        'cpu_seconds': own.ru_utime + own.ru_stime,
+        'children_cpu_seconds': children.ru_utime + children.ru_stime,
+    }
+
+
+def finish(args):
+    """ Write what --stats and --profile asked for"""
+    if _profile is not None:
+        _profile.disable()
+        _profile.dump_stats(args.profile)
+
+    if args.stats:
+        print(json.dumps(report(), indent=1, sort_keys=True),
+              file=sys.stderr)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# Proximity of query terms inside a document
+#
+# Every function takes one sorted list of positions per query term and
+# returns a window (start, end) of token positions, or None.
+import heapq
+from bisect import bisect_right
+
+
+def minimumWindow(position_lists):
+    """ Smallest window holding a position of every list, in any order
+
+    Merges the lists through a heap with one cursor per list: the window
+    from the smallest cursor to the largest one is a candidate, and only
+    advancing the smallest cursor can make it shorter.
+    O(sum of lengths * log(number of lists))."""
+    if not position_lists or not all(len(pl) for pl in position_lists):
+        return None
+
+    heap = [(pl[0], k, 0) for k, pl in enumerate(position_lists)]
+    heapq.heapify(heap)
+    hi = max(pl[0] for pl in position_lists)
+    best = (heap[0][0], hi)
+
+    while True:
+        lo, k, i = heapq.heappop(heap)
+        if hi - lo < best[1] - best[0]:
+            best = (lo, hi)
+        if i + 1 == len(position_lists[k]):
+            return best
+        nxt = position_lists[k][i + 1]
+        hi = max(hi, nxt)
+        heapq.heappush(heap, (nxt, k, i + 1))
+
+
+def orderedWindow(position_lists):
+    """ Smallest window holding the lists' positions in the lists' order
+
+    For each position of the first list, the following terms are chained to
+    their first position after the previous one. The cursors only move
+    forward, so it is O(sum of lengths) binary searches at most.
+    A window of length len(position_lists)-1 is an exact phrase."""
+    if not position_lists or not all(len(pl) for pl in position_lists):
+        return None
+
+    cursors = [0] * len(position_lists)
+    best = None
+    for start in position_lists[0]:
+        end = start
+        for k in range(1, len(position_lists)):
+            pl = position_lists[k]
+            cursors[k] = bisect_right(pl, end, cursors[k])
+            if cursors[k] == len(pl):
+                # later starts can't be chained either
+                return best
+            end = pl[cursors[k]]
+        if best is None or end - start < best[1] - best[0]:
+            best = (start, end)
+    return best
+
+
+def isPhrase(window, n_terms):
+    return window is not None and window[1] - window[0] == n_terms - 1
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# Query evaluation over postings lists sorted by doc id
+import heapq
+import itertools
+import math
+
+from mirscore import tfIdf
+
+
+def gallop(occ_list, doc_id, lo=0):
+    """ First index >= lo whose doc id is >= doc_id
+
+    Probes lo+1, lo+2, lo+4, ... and then binary searches the last jump, so
+    advancing a cursor costs O(log distance) instead of O(distance)."""
+    n = len(occ_list)
+    if lo >= n or occ_list[lo][0] >= doc_id:
+        return lo
+
+    step = 1
+    hi = lo + 1
+    while hi < n and occ_list[hi][0] < doc_id:
+        lo = hi
+        step *= 2
+        hi = lo + step
+
+    hi = min(hi, n)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if occ_list[mid][0] < doc_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def intersect(occ_lists):
+    """ Doc ids present in every postings list, in increasing order"""
+    if not occ_lists:
+        return []
+
+    occ_lists = sorted(occ_lists, key=len)
+    rarest, others = occ_lists[0], occ_lists[1:]
+    cursors = [0] * len(others)
+
+    docs = []
+    for doc_id, _, _ in rarest:
+        for k, occ_list in enumerate(others):
+            cursors[k] = gallop(occ_list, doc_id, cursors[k])
+            if cursors[k] == len(occ_list):
+                return docs
+            if occ_list[cursors[k]][0] != doc_id:
+                break
+        else:
+            docs.append(doc_id)
+
+    return docs
+
+
+def conjunctiveQuery(tokens, r_index, filelist):
+    """ (doc_id, fn) of the documents containing all tokens"""
+    if not tokens:
+        # none of the terms is in the index
+        return []
+
+    return [(doc_id, filelist[doc_id])
+            for doc_id in intersect([r_index[tok] for tok in tokens])]
+
+
+def maxScore(occ_list, n_docs, df=None):
+    """ Upper bound of the tfIdf contribution of a term to any document"""
+    idf = math.log10((n_docs-1)/(df or len(occ_list)))
+    if idf < 0:
+        # tf >= 1, so the least negative weight is the one with freq 1
+        return idf
+    return (1 + math.log10(max(freq for _, freq, _ in occ_list))) * idf
+
+
+def topK(tokens, r_index, n_docs, k, candidates=None, df=None):
+    """ The k best (doc_id, score) by summed tfIdf, best first
+
+    With candidates (sorted doc ids, e.g. from intersect) every term must
+    be present, otherwise documents with any of the terms are ranked.
+    Uses MaxScore: terms whose upper bounds can't lift a document over the
+    current k-th score are only probed for documents that might make it,
+    and a document is dropped as soon as its bound falls below it.
+    df is as in mirscore.tfIdfScores."""
+    if k <= 0 or not tokens:
+        return []
+
+    occ = {tok: r_index[tok] for tok in tokens}
+    if df is None:
+        df = {tok: len(occ[tok]) for tok in tokens}
+    ub = {tok: max(0, maxScore(occ[tok], n_docs, df[tok])) for tok in tokens}
+    heap = []  # (score, -doc_id), so ties keep the lowest doc ids
+
+    def threshold():
+        return heap[0][0] if len(heap) == k else -math.inf
+
+    def push(doc_id):
+        # exact score, summed in query order like sortDocuments
+        score = 0
+        for tok in tokens:
+            i = gallop(occ[tok], doc_id)
+            if i < len(occ[tok]) and occ[tok][i][0] == doc_id:
+                score += tfIdf(occ[tok][i][1], df[tok], n_docs)
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc_id))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -doc_id))
+
+    if candidates is not None:
+        order = sorted(tokens, key=lambda tok: ub[tok], reverse=True)
+        cursors = dict.fromkeys(tokens, 0)
+        total = sum(ub.values())
+        for doc_id in candidates:
+            partial, remaining = 0, total
+            for tok in order:
+                cursors[tok] = gallop(occ[tok], doc_id, cursors[tok])
+                freq = occ[tok][cursors[tok]][1]
+                partial += tfIdf(freq, df[tok], n_docs)
+                remaining -= ub[tok]
+                if partial + remaining <= threshold():
+                    break
+            else:
+                push(doc_id)
+    else:
+        # essential terms (order[n_ness:]) generate the candidates
+        order = sorted(tokens, key=lambda tok: ub[tok])
+        prefix = list(itertools.accumulate(ub[tok] for tok in order))
+        cursors = dict.fromkeys(tokens, 0)
+        n_ness = 0
+        while n_ness < len(order):
+            essential = [tok for tok in order[n_ness:]
+                         if cursors[tok] < len(occ[tok])]
+            if not essential:
+                break
+            doc_id = min(occ[tok][cursors[tok]][0] for tok in essential)
+
+            partial = 0
+            for tok in essential:
+                doc, freq, _ = occ[tok][cursors[tok]]
+                if doc == doc_id:
+                    partial += tfIdf(freq, df[tok], n_docs)
+                    cursors[tok] += 1
+
+            for j in range(n_ness - 1, -1, -1):
+                if partial + prefix[j] <= threshold():
+                    break
+                tok = order[j]
+                cursors[tok] = gallop(occ[tok], doc_id, cursors[tok])
+                if (cursors[tok] < len(occ[tok])
+                        and occ[tok][cursors[tok]][0] == doc_id):
+                    partial += tfIdf(occ[tok][cursors[tok]][1],
+                                     df[tok], n_docs)
+            else:
+                push(doc_id)
+
+            while n_ness < len(order) and prefix[n_ness] <= threshold():
+                n_ness += 1
+
+    return [(-neg_doc, score)
+            for score, neg_doc in sorted(heap, key=lambda x: (-x[0], -x[1]))]
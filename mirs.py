@@ -1,20 +1,46 @@
 #!/usr/bin/python
 import argparse
+import io
+import json
 import re
 import pickle
 import os
-from collections import Counter
+import sys
 import math
 import re
-from queue import PriorityQueue
-
-resplit = re.compile(r'[\W\d_\s]+')
+import shlex
+import time
+from bisect import bisect_right
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import Pool
+
+import mirbin
+import mircache
+import mirdict
+import mirprof
+import mircodec
+import mirseg
+import mirshard
+import mirstat
+from mirquery import conjunctiveQuery, topK
+from mirscore import bm25Scores, quaseScores, tfIdfScores
+from mirtok import iterTokens, iterTokensFrom
+from mirpost import Postings
+from mirprox import isPhrase, minimumWindow, orderedWindow
 
 # DEBUG = True
 DEBUG = False
 
+SEGMENTS = mircache.LRUCache(mircache.SEGMENTS_SIZE, 'segments')
+POSITION_LISTS = mircache.LRUCache(mircache.SEGMENTS_SIZE, 'position_lists')
+CHECKPOINTS = mircache.LRUCache(mircache.SEGMENTS_SIZE, 'checkpoints')
+RESULTS = mircache.LRUCache(mircache.RESULTS_SIZE, 'results')
+# (rootdir, filelist, r_index, generation, stats, dictionaries) of --batch
+BATCH = None
+
 
-def getArgs():
+def getArgs(argv=None, intermixed=False):
+    """ intermixed allows options after the first positional argument"""
     parser = argparse.ArgumentParser(
         description="Searchs <dir>'s Information Retrieval system.")
 
@@ -26,8 +52,18 @@ def getArgs():
                              '\t 0 = Internal Order;\n'
                              '\t 1 = TF-IDF;\n'
                              '\t 2 = Quase-TF-IDF;\n'
-                             '\t 3 = X;\n'
-                             '\t 4 = X (2 menores DF);\n')
+                             '\t 3 = Menor janela com todos os termos;\n'
+                             '\t 4 = Menor janela (2 menores DF);\n'
+                             '\t 5 = Menor janela com os termos na ordem '
+                             'da consulta;\n'
+                             '\t 6 = Frase exata;\n'
+                             '\t 7 = BM25;\n')
+
+    parser.add_argument('-k', type=int,
+                        help='Only rank the <k> best documents (with -o 1 or 7)')
+    parser.add_argument('--or', dest='disjunctive', action='store_true',
+                        help='Rank documents with ANY of the tokens '
+                             '(with -o 1 or 7)')
 
     parser.add_argument('-v', action='store_true',
                         help='print verborragic information for debugging purposes')
@@ -39,13 +75,45 @@ def getArgs():
     parser.add_argument('tokens', action="append", nargs='*',
                         help='directory to be processed')
 
-    return parser.parse_args()
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Keep the index loaded and answer queries on '
+                             'localhost:<PORT>')
+    parser.add_argument('--connect', type=int, metavar='PORT',
+                        help='Send the query to the server on '
+                             'localhost:<PORT>')
+
+    parser.add_argument('--batch', metavar='FILE',
+                        help='Answer the queries of <FILE> (- for stdin), '
+                             'one per line with its own options (e.g. '
+                             '"-o 1 casa gato"), as JSON lines')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes for --batch')
+
+    parser.add_argument('--stats', action='store_true',
+                        help='Print phase timings, counters and peak RSS '
+                             'as JSON to stderr')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Save a cProfile of the query to <FILE>')
+
+    if intermixed:
+        return parser.parse_intermixed_args(argv)
+    return parser.parse_args(argv)
 
 
 def getIndex(l: list, v):
-    for i, item in enumerate(l):
-        if item[0] == v:
-            return i
+    """ Index of doc v in the postings l (sorted by doc id), -1 if absent"""
+    if isinstance(l, Postings):
+        return l.find(v)
+    # bisect's key= needs Python 3.10
+    lo, hi = 0, len(l)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if l[mid][0] < v:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < len(l) and l[lo][0] == v:
+        return lo
 
     return -1
 
@@ -53,7 +121,7 @@ def getIndex(l: list, v):
 def unpickle(rootdir, out=True, ind_name='mir'):
     picklefn = '{}/{}.pickle'.format(rootdir, ind_name)
 
-    with open(picklefn, 'rb') as handle:
+    with mirprof.phase('unpickle'), open(picklefn, 'rb') as handle:
         unpickler = pickle.Unpickler(handle)
         validation_str = unpickler.load()
         if DEBUG:
@@ -62,6 +130,10 @@ def unpickle(rootdir, out=True, ind_name='mir'):
         r_index = unpickler.load()
         encoding_dic = unpickler.load()
         index_time = unpickler.load()
+        mirprof.count('index_bytes', handle.tell())
+
+    if validation_str == 'MIR 2.0b':
+        r_index = mirbin.MappedIndex(rootdir, ind_name)
 
     if DEBUG:
         print(filelist)
@@ -77,22 +149,43 @@ def unpickle(rootdir, out=True, ind_name='mir'):
     return filelist, r_index, encoding_dic, index_time
 
 
-def loadPositionLists(rootdir, out=True):
-    picklefn = '{}/mirp.pickle'.format(rootdir)
+def loadPositionList(rootdir, ind_name):
+    """ Position list of segment ind_name, mapped rather than read: only the
+    slices used are loaded (see mirbin.loadPositions)"""
+    if os.path.isfile(mirbin.positionsPath(rootdir, ind_name)):
+        return mirbin.loadPositions(rootdir, ind_name)
+
+    # indexes saved before the pickle format wrote p.pos
+    picklefn = '{}/{}p.pickle'.format(rootdir, ind_name)
 
     with open(picklefn, 'rb') as handle:
         unpickler = pickle.Unpickler(handle)
-        main_pl = unpickler.load()
-        print('Lista posicional principal com {} posições carregada'.format(len(main_pl)))
+        return unpickler.load()
 
-    picklefn = '{}/mirap.pickle'.format(rootdir)
 
-    with open(picklefn, 'rb') as handle:
-        unpickler = pickle.Unpickler(handle)
-        aux_pl = unpickler.load()
-        print('Lista posicional auxiliar com {} posições carregada'.format(len(aux_pl)))
+def checkpointsPath(rootdir, ind_name):
+    return '{}/{}o.pickle'.format(rootdir, ind_name)
+
+
+def loadCheckpoints(rootdir, ind_name):
+    """ doc_id : snippet checkpoints, None for indexes without them"""
+    try:
+        with open(checkpointsPath(rootdir, ind_name), 'rb') as handle:
+            return pickle.load(handle)
+    except FileNotFoundError:
+        return None
 
-    return main_pl, aux_pl
+
+def loadPositionLists(rootdir, names, out=True):
+    """ name : position list of every segment"""
+    pos_lists = {}
+    for k, name in enumerate(names):
+        pos_lists[name] = readCached(POSITION_LISTS, loadPositionList,
+                                     rootdir, name)
+        print('Lista posicional {} com {} posições carregada'.format(
+            'auxiliar' if k else 'principal', len(pos_lists[name])))
+
+    return pos_lists
 
 
 def printEndMsg(args, top_tokens: int, docs_size: int):
@@ -113,71 +206,68 @@ def printEndMsg(args, top_tokens: int, docs_size: int):
     print(end_msg)
 
 
-def printStartMsg(rootdir, aux, rem):
-    if rem:
-        print("Instruções de exclusão ao indexador tomadas de "
-              "{}/mira.rem".format(rootdir))
-    if aux:
+def printStartMsg(rootdir, names, removed):
+    for name in names[1:]:
+        if removed[name]:
+            print("Instruções de exclusão ao indexador tomadas de "
+                  "{}".format(mirseg.removedPath(rootdir, name)))
+    if len(names) > 1:
         print("MIR (My Information Retrieval System) de atualização"
-              " dinâmica ('{0}/mir.pickle', "
-              "'{0}/mira.pickle')".format(rootdir))
-
-
-def removeDeletedFiles(filelist, r_index, rootdir):
+              " dinâmica ({})".format(', '.join(
+                  "'{}/{}.pickle'".format(rootdir, name) for name in names)))
 
-    with open('{}/mira.rem'.format(args.dir), 'r') as handle:
-        rm_files = [line.split()[-1] for line in handle.readlines()]
 
-    rm_ind = [filelist.index(x) for x in rm_files]
+def removeDocuments(filelist, r_index, rm_ind):
+    """ Drop the doc ids rm_ind from every postings list
 
-    # Code to remove files in "mira.rem" from filelist, but this
-    # has behaviour incompatible with examples
+    Doc ids of the remaining files don't change, removed files keep their
+    place in filelist."""
+    if not rm_ind:
+        return filelist, r_index
 
-    # new_filelist = [fn for fn in filelist if not fn in rm_files]
-    # mapping = {filelist.index(fn): new_filelist.index(fn)
-    #            for fn in new_filelist}
-
-    # for tok in r_index:
-    #     l = r_index[tok]
-    #     l = [(mapping[file_c], count)
-    #          for (file_c, count) in l if not file_c in rm_ind]
-    #     r_index[tok] = l
+    if isinstance(r_index, mirbin.MappedIndex):
+        # filtered when each postings list is read
+        r_index.exclude(rm_ind)
+        return filelist, r_index
 
     for tok in r_index:
-        l = r_index[tok]
-        l = [(file_c, count, ini)
-             for (file_c, count, ini) in l if not file_c in rm_ind]
-        r_index[tok] = l
+        r_index[tok] = Postings.fromList(r_index[tok]).without(rm_ind)
+
+    return filelist, r_index
 
-    return filelist, r_index, len(rm_ind)
 
+def combineIndexes(main_fl, main_rind, aux_fl, aux_rind, keep):
+    """ Add the documents keep (aux doc ids) of aux_rind to main_rind
 
-def combineIndexes(main_fl, main_rind, aux_fl, aux_rind):
+    Their old versions must have been removed from main_rind already."""
     filelist = main_fl
-    mapping = {}
-    for c, fn in enumerate(aux_fl):
-        if fn in main_fl:
-            mapping[c] = main_fl.index(fn)
-        else:
-            mapping[c] = len(main_fl)
+    doc_ids = {fn: c for c, fn in enumerate(main_fl)}
+    mapping = []  # aux doc id : main doc id
+    for fn in aux_fl:
+        if fn not in doc_ids:
+            doc_ids[fn] = len(main_fl)
             main_fl.append(fn)
+        mapping.append(doc_ids[fn])
+
+    # doc ids of the files new to main_fl keep their order, those of
+    # replaced files may not
+    ordered = all(a < b for a, b in zip(mapping, mapping[1:]))
 
     r_index = main_rind
     for tok, aux_val in aux_rind.items():
 
         # convert to new indexes
-        aux_val = [(mapping[c], token_freq, ini)
-                   for c, token_freq, ini in aux_val]
+        aux_val = Postings.fromList(aux_val)
+        if len(keep) < len(aux_fl):
+            aux_val = aux_val.only(keep)
+        if not aux_val:
+            continue
+        aux_val = aux_val.remap(mapping, ordered)
 
         main_val = r_index.get(tok)
 
-        if main_val is not None:
-            for c, freq, ini in aux_val:
-                i = getIndex(main_val, c)
-                if i >= 0:
-                    main_val[i] = (c, freq, ini)
-                else:
-                    main_val.append((c, freq, ini))
+        if main_val:
+            main_val = Postings.fromList(main_val).merge(aux_val)
         else:
             main_val = aux_val
         r_index[tok] = main_val
@@ -186,43 +276,115 @@ def combineIndexes(main_fl, main_rind, aux_fl, aux_rind):
 
 
 def loadCombinedIndex(args):
-    hasAux = os.path.isfile(os.path.join(args.dir, 'mira.pickle'))
-    hasRem = os.path.isfile(os.path.join(args.dir, 'mira.rem'))
+    """ (filelist, r_index) of every segment of args.dir, for an index
+    built with mir.py -S (None, the mirshard.ShardedIndex serving it)"""
+    if mirshard.isSharded(args.dir):
+        index = mirshard.ShardedIndex(args.dir)
+        print("MIR (My Information Retrieval System) de {}\n"
+              "com {} documentos em {} shards".format(
+                  mirshard.manifestPath(args.dir), index.n_docs,
+                  len(index.names)))
+        return None, index
+
+    names = mirseg.segmentNames(args.dir)
+    removed = {name: mirseg.readRemoved(args.dir, name) for name in names}
+
+    printStartMsg(args.dir, names, removed)
+
+    segments = []
+    for name in names:
+        key = segmentKey(args.dir, name)
+        seg_fl, seg_index, seg_enc, _ = unpickle(args.dir, ind_name=name)
+        # kept as read for loadSegments, the base is combined in a copy
+        SEGMENTS.put(key, (seg_fl, seg_index, seg_enc))
+        segments.append((name, seg_fl, seg_index))
+    live, removed_count = mirseg.liveSources(
+        [(name, seg_fl, removed[name] if k else ())
+         for k, (name, seg_fl, _) in enumerate(segments)])
+
+    base, filelist, r_index = segments[0]
+    filelist = list(filelist)
+    if isinstance(r_index, mirbin.MappedIndex):
+        r_index = mirbin.MappedIndex(args.dir, base)
+    else:
+        r_index = dict(r_index)
+    with mirprof.phase('combine'):
+        filelist, r_index = removeDocuments(
+            filelist, r_index,
+            {c for c, fn in enumerate(filelist) if live.get(fn) != base})
 
-    printStartMsg(args.dir, hasAux, hasRem)
+        for name, seg_fl, seg_index in segments[1:]:
+            filelist, r_index = combineIndexes(
+                filelist, r_index, seg_fl, seg_index,
+                {c for c, fn in enumerate(seg_fl) if live.get(fn) == name})
 
-    filelist, r_index, _, _ = unpickle(args.dir)
+    print('Arquivos caducados ou removidos: {}'.format(removed_count))
+    print('Indice conjugado com {} termos e {} documentos'.format(
+        len(r_index), len(filelist)))
 
-    if hasRem:
-        filelist, r_index, removed_count = removeDeletedFiles(
-            filelist, r_index, args.dir)
+    return filelist, r_index
 
-    if hasAux:
-        aux_filelist, aux_index, _, _ = unpickle(args.dir, ind_name='mira')
 
-        removed_count += len([x for x in filelist if x in aux_filelist])
+def segmentKey(rootdir, name):
+    """ Changes whenever segment name is rewritten"""
+    stat = os.stat('{}/{}.pickle'.format(rootdir, name))
+    return os.path.realpath(rootdir), name, stat.st_mtime_ns, stat.st_size
 
-        filelist, r_index = combineIndexes(
-            filelist, r_index, aux_filelist, aux_index)
 
-    print('Arquivos caducados ou removidos: {}'.format(removed_count))
-    print('Indice conjugado com {} termos e {} documentos'.format(
-        len(r_index), len(filelist)))
+def readCached(cache, load, rootdir, name):
+    """ load(rootdir, name) through cache, the result is shared: not to be
+    modified"""
+    key = segmentKey(rootdir, name)
+    value = cache.get(key)
+    if value is None:
+        value = load(rootdir, name)
+        cache.put(key, value)
+    return value
 
-    return filelist, r_index
 
+def readSegment(rootdir, name):
+    """ (filelist, r_index, encoding_dic) of segment name as saved"""
+    return readCached(
+        SEGMENTS, lambda rootdir, name: unpickle(rootdir, False, name)[:3],
+        rootdir, name)
 
-def filterTokens(args, counter: Counter, out: bool = True):
+
+def loadSegments(rootdir, tokens):
+    """ Segments as (name, filelist, postings of tokens, encoding_dic, doc
+    ids) and fn : name of the segment holding the current version of fn"""
+    segments = []
+    for name in mirseg.segmentNames(rootdir):
+        seg_fl, seg_index, seg_enc = readSegment(rootdir, name)
+        segments.append((name, seg_fl, termSubset(seg_index, tokens),
+                         seg_enc, {fn: c for c, fn in enumerate(seg_fl)}))
+
+    live, _ = mirseg.liveSources(
+        [(name, seg_fl, mirseg.readRemoved(rootdir, name) if k else ())
+         for k, (name, seg_fl, _, _, _) in enumerate(segments)])
+    return segments, live
+
+
+def termSubset(r_index, tokens):
+    """ Plain dict with the postings of tokens, read once from r_index"""
+    return {tok: r_index[tok] for tok in tokens if tok in r_index}
+
+
+def filterTokens(args, tokens: list, out: bool = True, dictionaries=None):
+    """ The tokens selected by -r or -R, in the same order
+
+    The regex is only tested on the candidate terms of the mirdict
+    dictionaries, if given."""
+    regex = args.r if args.r is not None else args.R
+    if regex is not None and dictionaries is not None:
+        search = mirdict.searchTerms(dictionaries, regex).__contains__
+    elif regex is not None:
+        search = regex.search
 
     if args.r is not None:
-        counter_filtered = Counter({
-            tok: counter[tok]
-            for tok in counter
-            if args.r.search(tok)
-        })
-
-        total = len(counter)
-        matched = len(counter_filtered)
+        tokens_filtered = [tok for tok in tokens if search(tok)]
+
+        total = len(tokens)
+        matched = len(tokens_filtered)
         not_matched = total - matched
 
         if out:
@@ -235,14 +397,10 @@ def filterTokens(args, counter: Counter, out: bool = True):
                       not_matched, not_matched/matched
                   ))
     elif args.R is not None:
-        counter_filtered = Counter({
-            tok: counter[tok]
-            for tok in counter
-            if not args.R.search(tok)
-        })
-
-        total = len(counter)
-        not_matched = len(counter_filtered)
+        tokens_filtered = [tok for tok in tokens if not search(tok)]
+
+        total = len(tokens)
+        not_matched = len(tokens_filtered)
         matched = total - not_matched
 
         if out:
@@ -255,108 +413,36 @@ def filterTokens(args, counter: Counter, out: bool = True):
                       matched, matched/not_matched
                   ))
     else:
-        counter_filtered = counter
-
-    return counter_filtered
-
-
-def TF_IDF(doc_id, token,
-           filelist, occ_list):
-    ind = getIndex(occ_list, doc_id)
-
-    tf = 1 + math.log10(occ_list[ind][1])
-
-    return tf * math.log10((len(filelist)-1)/len(occ_list))
-
-
-def Quase_TF_IDF(doc_id, token, main_fl, aux_fl, main_ocl, aux_ocl):
-    freq = 0
+        tokens_filtered = tokens
 
-    ind = getIndex(main_ocl, doc_id)
-    if ind != -1:
-        freq += main_ocl[ind][1]
-    ind = getIndex(aux_ocl, doc_id)
+    return tokens_filtered
 
-    if ind != -1:
-        freq += aux_ocl[ind][1]
 
-    tf = 1 + math.log10(freq)
+def positionSlice(pos_list, ini, freq):
+    """ Positions of one (token, doc) occurrence, whatever the storage"""
+    mirprof.count('positions_read', freq)
+    if isinstance(pos_list, mircodec.PackedPositions):
+        return pos_list.read(ini, freq)
+    return pos_list[ini:ini+freq]
 
-    q_df = (len(main_fl)+len(aux_fl))/(len(main_ocl) + len(aux_ocl))
 
-    return tf * math.log10(q_df)
-
-
-def getTermDistances(tokens, doc_id, r_index, pos_list):
-    d = {}  # (t,u) : [pos(t),pos(u)] smallest distance between t and u
-
-    for i in range(len(tokens)-1):
-        t, u = tokens[i], tokens[i+1]
-        t_freq, t_start = r_index[t][getIndex(r_index[t], doc_id)][1:]
-        u_freq, u_start = r_index[u][getIndex(r_index[u], doc_id)][1:]
-        min_dist = float('inf')
-        min_pos = (-1, -1)
-        # print(t, u)
-        for j in range(t_start, t_start+t_freq, 1):
-            for k in range(u_start, u_start+u_freq, 1):
-                t_pos = pos_list[j]
-                u_pos = pos_list[k]
-
-                # print('-- ', t_pos, u_pos)
-                dist = abs(t_pos - u_pos)
-
-                if dist < min_dist:
-                    min_dist = dist
-                    min_pos = (t_pos, u_pos)
-                    # print(min_pos)
-
-        d[(t, u)] = min_pos
-
-    return d
-
-
-def joinIntervals(distances, tokens):
-
-    q = PriorityQueue()
-    for k, v in distances.items():
-        q.put((posDif(v), set(k), v))
-
-    while not q.empty():
-        _, tok, interval = q.get()
-        if all([(t in tok) for t in tokens]):
-            return interval
-
-        t = ''
-        for i in tokens:
-            if not i in tok:
-                t = i
-
-        # add t to this item
-
-        val = None
-        for x in tok:
-            val = distances.get((x, t))
-            if val is not None:
-                break
-            val = distances.get((t, x))
-            if val is not None:
-                break
-
-        interval = (
-            min(min(interval), min(val)),
-            max(max(interval), max(val))
-        )
-        tok.add(t)
-        q.put((posDif(interval), tok, interval))
-
-    return
+def termPositions(r_index, tok, doc_id, pos_list):
+    """ Sorted positions of tok in doc_id"""
+    _, freq, ini = r_index[tok][getIndex(r_index[tok], doc_id)]
+    return positionSlice(pos_list, ini, freq)
 
 
 def posDif(x):
     return int(abs(x[0]-x[1]))
 
 
-def readInterval(flag, interval, filepath, enc):
+def readInterval(flag, interval, filepath, enc, checkpoints=None,
+                 highlight=()):
+    """ Tokens around interval, reading from the last checkpoint before it
+
+    Without checkpoints (indexes built before they existed) the file is
+    tokenized from the start. Tokens in highlight are shown in bold on a
+    terminal."""
     if not flag:
         return ''
 
@@ -364,33 +450,91 @@ def readInterval(flag, interval, filepath, enc):
     end = max(interval)
 
     string = '{}-{} '.format(start+1, end+1)
+    bold = '\033[1m{}\033[0m' if sys.stdout.isatty() else '{}'
 
     start -= 3
     end += 3
-    with open(filepath, 'r', encoding=enc) as handle:
-        words_gen = (
-            word.lower()
-            for line in handle
-            for word in resplit.split(line)
-            if word != ''
-        )
+    with mirprof.phase('snippets'), open(
+            filepath, 'r', encoding=enc['encoding'],
+            errors=enc['errors']) as handle:
+        if checkpoints:
+            k = bisect_right(checkpoints, (max(start, 0), math.inf)) - 1
+            tokens = iterTokensFrom(handle, checkpoints[max(k, 0)])
+        else:
+            tokens = enumerate(iterTokens(handle))
 
-        for i, token in enumerate(words_gen):
+        for i, token in tokens:
             if i >= start and i <= end:
+                if token in highlight:
+                    token = bold.format(token)
                 string += token+' '
             elif i > end:
                 break
+        mirprof.count('snippet_bytes', handle.buffer.tell())
 
     return string
 
 
+def printRanked(ranked, filelist):
+    for doc_id, score in ranked:
+        print("\t{:2d}\t{:.2f}\t{}".
+              format(doc_id, score, filelist[doc_id]))
+
+
+def documentLengths(filelist, segments, live):
+    """ Number of tokens of each doc id of filelist, None if removed"""
+    encs = {seg[0]: seg[3] for seg in segments}
+    lengths = []
+    missing = []
+    for c, fn in enumerate(filelist):
+        n = encs[live[fn]][fn].get('tokens') if fn in live else None
+        if n is None and fn in live:
+            missing.append(c)
+        lengths.append(n)
+
+    if missing:
+        # indexes built before the lengths were stored
+        print('Tamanho desconhecido de {} documentos, usado o tamanho médio. '
+              'Reconstrua o índice com mir.py'.format(len(missing)))
+        known = [n for n in lengths if n is not None]
+        average = sum(known) / len(known) if known else 1
+        for c in missing:
+            lengths[c] = average
+    return lengths
+
+
+def queryDF(tokens, r_index, stats):
+    """ token : DF of the query's tokens from the statistics table, None
+    without one. Patterns (see expandQuery) aren't in it, they count the
+    documents of their merged postings"""
+    if stats is None:
+        return None
+    return {tok: stats['df'][tok] if tok in stats['df']
+            else len(r_index[tok]) for tok in tokens}
+
+
+def rankBM25(tokens, r_index, filelist, rootdir, candidates=None,
+             stats=None):
+    """ (doc_id, score) by BM25, best first"""
+    if stats is not None:
+        lengths = stats['lengths']
+    else:
+        lengths = documentLengths(filelist, *loadSegments(rootdir, tokens))
+    scores = bm25Scores(tokens, r_index, lengths, candidates,
+                        df=queryDF(tokens, r_index, stats))
+    if candidates is None:
+        candidates = list(scores)
+    return sorted(((doc_id, scores[doc_id]) for doc_id in candidates),
+                  key=lambda x: (-x[1], x[0]))
+
+
 def sortDocuments(mode, documents, tokens, r_index, filelist,
-                  rootdir, verbose):
+                  rootdir, verbose, k=None, stats=None):
 
     print("São {} os documentos com os {} termos"
           .format(len(documents), len(tokens)))
 
-    if mode < 0 or mode > 4:
+    if mode < 0 or mode > 7:
         print('WRONG VALUE FOR -o')
         exit(1)
 
@@ -399,38 +543,54 @@ def sortDocuments(mode, documents, tokens, r_index, filelist,
             print("\t{:2d}\t{}".format(i, fn))
         return
 
+    if mode == 1 and k is not None:
+        with mirprof.phase('scoring'):
+            ranked = topK(tokens, r_index, len(filelist), k,
+                          [doc_id for doc_id, _ in documents],
+                          queryDF(tokens, r_index, stats))
+        printRanked(ranked, filelist)
+        return
+
     if mode == 1:
-        tf_idf_sum = {fn: sum([
-            TF_IDF(doc_id, tok, filelist, r_index[tok])
-            for tok in tokens])
-            for doc_id, fn in documents
-        }
+        with mirprof.phase('scoring'):
+            tf_idf_sum = tfIdfScores(tokens, r_index, len(filelist),
+                                     {doc_id for doc_id, _ in documents},
+                                     queryDF(tokens, r_index, stats))
 
-        for doc_id, fn in sorted(documents, key=lambda x: tf_idf_sum[x[1]], reverse=True):
+        for doc_id, fn in sorted(documents, key=lambda x: tf_idf_sum[x[0]], reverse=True):
             print("\t{:2d}\t{:.2f}\t{}".
-                  format(doc_id, tf_idf_sum[fn], fn))
+                  format(doc_id, tf_idf_sum[doc_id], fn))
+        return
+
+    if mode == 7:
+        with mirprof.phase('scoring'):
+            ranked = rankBM25(tokens, r_index, filelist, rootdir,
+                              {doc_id for doc_id, _ in documents}, stats)
+        printRanked(ranked[:k], filelist)
         return
 
-    main_fl, main_index, main_enc, _ = unpickle(rootdir, out=False)
-    aux_fl, aux_index, aux_enc, _ = unpickle(
-        rootdir, out=False, ind_name='mira')
+    with mirprof.phase('segments'):
+        segments, live = loadSegments(rootdir, tokens)
 
     if mode == 2:
-        tf_idf_sum = {fn: sum([
-            Quase_TF_IDF(doc_id, tok, main_fl, aux_fl,
-                         main_index[tok], aux_index[tok])
-            for tok in tokens])
-            for doc_id, fn in documents
-        }
-
-        # documents = []
+        with mirprof.phase('scoring'):
+            tf_idf_sum = quaseScores([fn for _, fn in documents], tokens,
+                                     segments,
+                                     queryDF(tokens, r_index, stats))
 
         for doc_id, fn in sorted(documents, key=lambda x: tf_idf_sum[x[1]], reverse=True):
             print("\t{:2d}\t{:.2f}\t{}".
                   format(doc_id, tf_idf_sum[fn], fn))
         return
 
-    main_posl, aux_posl = loadPositionLists(rootdir)
+    with mirprof.phase('positions'):
+        pos_lists = loadPositionLists(rootdir,
+                                      [seg[0] for seg in segments])
+        if verbose:
+            checkpoints = {seg[0]: readCached(CHECKPOINTS, loadCheckpoints,
+                                              rootdir, seg[0])
+                           for seg in segments}
+    by_name = {seg[0]: seg for seg in segments}
 
     if mode == 4:
         # Filter tokens
@@ -438,26 +598,31 @@ def sortDocuments(mode, documents, tokens, r_index, filelist,
         tokens = tokens[:2]
 
     d = {}
-    for _, fn in documents:
-        if fn in aux_fl:
-            d[fn+'enc'] = aux_enc[fn]['encoding']
-            distances = getTermDistances(
-                tokens, aux_fl.r_index(fn), aux_index, aux_posl)
-        else:
-            d[fn+'enc'] = main_enc[fn]['encoding']
-            distances = getTermDistances(
-                tokens, main_fl.index(fn), main_index, main_posl)
-
-        d[fn] = distances
-
-    if mode == 3:
-        # Join all token distances
+    with mirprof.phase('scoring'):
         for _, fn in documents:
-            d[fn] = joinIntervals(d[fn], tokens)
+            name = live[fn]
+            _, _, seg_index, seg_enc, seg_ids = by_name[name]
+            d[fn+'enc'] = seg_enc[fn]
+            if verbose and checkpoints[name]:
+                d[fn+'chk'] = checkpoints[name][seg_ids[fn]]
+            position_lists = [
+                termPositions(seg_index, tok, seg_ids[fn], pos_lists[name])
+                for tok in tokens]
+
+            if mode in (5, 6):
+                # tokens are in query order for these modes
+                d[fn] = orderedWindow(position_lists)
+            else:
+                d[fn] = minimumWindow(position_lists)
 
-    else:
-        for _, fn in documents:
-            d[fn] = min(d[fn].items(), key=lambda x: posDif(x[1]))[1]
+    # no window without positions of every term
+    documents = [(doc_id, fn) for doc_id, fn in documents
+                 if d[fn] is not None]
+    if mode in (5, 6):
+        documents = [(doc_id, fn) for doc_id, fn in documents
+                     if mode == 5 or isPhrase(d[fn], len(tokens))]
+        print("Em {} deles os termos aparecem {}".format(
+            len(documents), 'na ordem' if mode == 5 else 'como frase'))
 
     for doc_id, fn in sorted(documents, key=lambda x: posDif(d[x[1]])):
         print(
@@ -466,38 +631,117 @@ def sortDocuments(mode, documents, tokens, r_index, filelist,
                    readInterval(
                 verbose, d[fn],
                 os.path.join(rootdir, fn),
-                d[fn+'enc'])
+                d[fn+'enc'], d.get(fn+'chk'), tokens)
             )
         )
 
 
-if __name__ == "__main__":
-
-    args = getArgs()
-
-    if args.dir[-1] == '/':
-        args.dir = args.dir[:-1]
-
-    if DEBUG:
-        print(args)
-
-    filelist, r_index = loadCombinedIndex(args)
+def indexGeneration(rootdir):
+    """ Size and mtime of every index file in rootdir, changes on rebuilds"""
+    return tuple(sorted(
+        (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+        for entry in os.scandir(rootdir)
+        if entry.name.startswith('mir') and entry.is_file()
+    ))
+
+
+def expandQuery(query, r_index, dictionaries):
+    """ The query's terms found and their postings, for a pattern (see
+    mirdict) those of the documents with any term it matches. Prints the
+    DF of each one"""
+    tokens = []
+    postings = {}
+    for tok in query:
+        if mirdict.isPattern(tok):
+            if dictionaries is None:
+                # index without dictionaries, scan its terms
+                dictionaries = [mirdict.TermDictionary(r_index.keys(),
+                                                       index_grams=False)]
+            terms = [term for term in mirdict.expandPattern(dictionaries, tok)
+                     if term in r_index]
+            if not terms:
+                print('\tPadrão {} não encontrado.'.format(tok))
+                continue
+            print('\tPadrão {} expandido em {} termos: {}'.format(
+                tok, len(terms), ' '.join(terms)))
+            ind = Postings.union(r_index[term] for term in terms)
+        else:
+            ind = r_index.get(tok)
+            if ind is None:
+                print('\tToken {} não encontrado.'.format(tok))
+                continue
+        print('\t{:2d}\t{: <10}\t{}'.format(
+            len(ind), tok, [x[0] for x in ind]))
+        tokens.append(tok)
+        postings[tok] = ind
+
+    return tokens, postings
+
+
+def queryKey(args):
+    """ What the output of runQuery depends on, besides the index"""
+    tokens = args.tokens[0]
+    if args.order not in (5, 6):
+        # the other modes don't depend on the terms' order
+        tokens = sorted(tokens)
+    return (args.t, args.r and args.r.pattern, args.R and args.R.pattern,
+            args.order, args.k, args.disjunctive, args.v, tuple(tokens))
+
+
+def cachedQuery(args, filelist, r_index, generation, stats=None,
+                dictionaries=None):
+    """ runQuery, printing the saved output of the same query on the same
+    index generation (see indexGeneration) if there is one"""
+    if args.v and sys.stdout.isatty():
+        # snippets would lose their highlights
+        return runQuery(args, filelist, r_index, stats, dictionaries)
+
+    key = (queryKey(args), generation)
+    output = RESULTS.get(key)
+    if output is not None:
+        print(output, end='')
+        return
 
-    tokens = [x for x in r_index.keys()]
-    tokens.sort()
-    counter = Counter({k: len(r_index[k]) for k in tokens})
+    out = io.StringIO()
+    try:
+        with redirect_stdout(out):
+            runQuery(args, filelist, r_index, stats, dictionaries)
+    finally:
+        # also the messages of a query that exits with an error
+        print(out.getvalue(), end='')
+    RESULTS.put(key, out.getvalue())
+
+
+def runQuery(args, filelist, r_index, stats=None, dictionaries=None):
+    """ stats and dictionaries are the mirstat table and mirdict
+    dictionaries of the index, read from args.dir if needed and not given"""
+    if isinstance(r_index, mirshard.ShardedIndex):
+        return r_index.runQuery(args)
+
+    if stats is None and (args.t is not None or args.order in (1, 2, 7)):
+        stats = mirstat.indexStats(args.dir)
+    patterns = [tok for tok in args.tokens[0] if mirdict.isPattern(tok)]
+    if dictionaries is None and (
+            patterns or (args.t is not None and (args.r or args.R))):
+        dictionaries = mirdict.loadDictionaries(args.dir)
 
     if args.t is not None:
+        if stats is not None:
+            df, by_df = stats['df'], stats['by_df']
+        else:
+            df = {tok: len(r_index[tok]) for tok in r_index.keys()}
+            by_df = sorted(df, key=lambda tok: (-df[tok], tok))
 
-        counter_filtered = filterTokens(args, counter)
-        top_tokens = counter_filtered.most_common(args.t)
+        with mirprof.phase('filter'):
+            top_tokens = filterTokens(args, by_df, True,
+                                      dictionaries)[:args.t]
 
         print('\tDF\tTermo/Token\tLista de incidência com IDs dos arquivos')
 
         docs = set()
-        for tok, count in top_tokens:
+        for tok in top_tokens:
             print('\t{:2d}\t{: <10}\t{}'.format(
-                count, tok, [x[0] for x in r_index[tok]]))
+                df[tok], tok, [x[0] for x in r_index[tok]]))
             for i in r_index[tok]:
                 docs.add(i)
 
@@ -509,27 +753,136 @@ if __name__ == "__main__":
 
         print('\tDF\tTermo/Token\tLista de incidência com IDs dos arquivos')
 
+        if patterns and args.order not in (0, 1, 7):
+            print('Padrões só são suportados com -o 0, 1 ou 7')
+            exit(1)
+
+        query_order = list(args.tokens[0])
         args.tokens[0].sort(reverse=True)
 
-        tokens = []
-        for tok in args.tokens[0]:
-            ind = r_index.get(tok)
-            if ind is not None:
-                print('\t{:2d}\t{: <10}\t{}'.format(
-                    counter[tok], tok, [x[0] for x in r_index[tok]]))
-                tokens.append(tok)
-            else:
-                print('\tToken {} não encontrado.'.format(tok))
+        with mirprof.phase('expand'):
+            tokens, r_index = expandQuery(args.tokens[0], r_index,
+                                          dictionaries)
+
+        if args.order in (5, 6):
+            # ordered modes need the terms as typed
+            tokens = [tok for tok in query_order if tok in r_index]
+
+        if args.disjunctive:
+            if args.order not in (1, 7):
+                print('--or só é suportado com -o 1 ou 7')
+                exit(1)
+
+            k = args.k if args.k is not None else len(filelist)
+            with mirprof.phase('scoring'):
+                if args.order == 7:
+                    ranked = rankBM25(tokens, r_index, filelist, args.dir,
+                                      stats=stats)[:k]
+                else:
+                    ranked = topK(tokens, r_index, len(filelist), k,
+                                  df=queryDF(tokens, r_index, stats))
+            print("Os {} documentos mais relevantes com algum dos {} termos"
+                  .format(len(ranked), len(tokens)))
+            printRanked(ranked, filelist)
+        else:
+            with mirprof.phase('intersection'):
+                docs = conjunctiveQuery(tokens, r_index, filelist)
+            mirprof.count('results', len(docs))
+
+            sortDocuments(args.order, docs, tokens, r_index,
+                          filelist, args.dir, args.v, args.k, stats)
+
+
+def answerQuery(query):
+    """ JSON-able answer of one --batch line (number, text), against the
+    index in BATCH"""
+    n, line = query
+    rootdir, filelist, r_index, generation, stats, dictionaries = BATCH
+    answer = {'line': n, 'query': line}
+    out = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with redirect_stdout(out), redirect_stderr(out):
+            args = getArgs([rootdir] + shlex.split(line), intermixed=True)
+            cachedQuery(args, filelist, r_index, generation, stats,
+                        dictionaries)
+    except SystemExit as e:
+        if e.code:
+            answer['error'] = 'exit {}'.format(e.code)
+    except Exception as e:
+        answer['error'] = '{}: {}'.format(type(e).__name__, e)
+    answer['seconds'] = time.perf_counter() - start
+    answer['output'] = out.getvalue()
+    return answer
+
+
+def runBatch(args):
+    """ Answer the queries of args.batch, as JSON lines in the same order
+
+    The index is loaded once, then forked into args.jobs worker processes
+    (queries print their results, so they can't share one sys.stdout)."""
+    global BATCH
+    with (sys.stdin if args.batch == '-' else open(args.batch)) as handle:
+        queries = [(n, line.strip()) for n, line in enumerate(handle, 1)
+                   if line.strip() and not line.lstrip().startswith('#')]
+
+    # progress messages go to stderr, stdout only has the answers
+    with redirect_stdout(sys.stderr):
+        with mirprof.phase('load'):
+            generation = indexGeneration(args.dir)
+            filelist, r_index = loadCombinedIndex(args)
+            stats = mirstat.indexStats(args.dir)
+            dictionaries = mirdict.loadDictionaries(args.dir)
+            sharded = isinstance(r_index, mirshard.ShardedIndex)
+            if not sharded:
+                # read before forking, so the workers share them
+                loadPositionLists(args.dir, mirseg.segmentNames(args.dir))
+    BATCH = (args.dir, filelist, r_index, generation, stats, dictionaries)
+
+    with mirprof.phase('queries'):
+        # shards already answer in parallel, and pool workers can't start
+        # processes of their own
+        if args.jobs > 1 and not sharded:
+            with Pool(args.jobs) as pool:
+                for answer in pool.imap(answerQuery, queries, chunksize=16):
+                    print(json.dumps(answer, ensure_ascii=False), flush=True)
+        else:
+            for answer in map(answerQuery, queries):
+                print(json.dumps(answer, ensure_ascii=False), flush=True)
+    mirprof.count('queries', len(queries))
+
+
+if __name__ == "__main__":
+
+    args = getArgs()
+
+    if args.dir[-1] == '/':
+        args.dir = args.dir[:-1]
+
+    if DEBUG:
+        print(args)
+
+    if args.connect is not None:
+        import mirserver
+        print(mirserver.query(args.connect, args.dir, sys.argv[1:]), end='')
+        exit(0)
+
+    if args.serve is not None:
+        import mirserver
+        mirserver.serve(args, args.serve)
+        exit(0)
+
+    if args.profile:
+        mirprof.startProfile()
+
+    # merges wait for the query before removing the segments it reads
+    with mirseg.reading(args.dir):
+        if args.batch is not None:
+            runBatch(args)
+        else:
+            with mirprof.phase('load'):
+                filelist, r_index = loadCombinedIndex(args)
+
+            runQuery(args, filelist, r_index)
 
-        docs = []
-        for i, fn in enumerate(filelist):
-            if all([
-                any([
-                    i == c
-                    for c, _, _ in r_index[tok]])
-                for tok in tokens
-            ]):
-                docs.append((i, fn))
-
-        sortDocuments(args.order, docs, tokens, r_index,
-                      filelist, args.dir, args.v)
+    mirprof.finish(args)
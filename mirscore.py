@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# Ranking functions
+#
+# Each *Scores function walks the postings of one query term at a time and
+# adds its weight to every document it lists, so the cost follows the
+# postings' length and the per-term factors (idf, ...) are computed once.
+# Scores are summed in query order, like the per-document sums they
+# replace, which keeps them bit for bit identical.
+import math
+from collections import defaultdict
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tfIdf(freq, df, n_docs):
+    """ Weight of a term in a document, as in -o 1"""
+    return (1 + math.log10(freq)) * math.log10((n_docs-1)/df)
+
+
+def tfIdfScores(tokens, r_index, n_docs, candidates=None, df=None):
+    """ doc_id : summed tfIdf of tokens, for the doc ids in candidates (a
+    set) or for every document with one of the tokens
+
+    df (token : document frequency) defaults to the length of the
+    postings, a shard (see mirshard) passes that of the whole collection."""
+    scores = defaultdict(float)
+    for tok in tokens:
+        occ_list = r_index[tok]
+        idf = math.log10((n_docs-1)/(df[tok] if df else len(occ_list)))
+        for doc_id, freq, _ in occ_list:
+            if candidates is None or doc_id in candidates:
+                scores[doc_id] += (1 + math.log10(freq)) * idf
+    return scores
+
+
+def quaseScores(fns, tokens, segments, df=None, n_files=None):
+    """ fn : summed Quase-TF-IDF of tokens, for the file names in fns
+
+    The frequency of a term in a file and its document frequency add up
+    over every segment (name, filelist, r_index, ...) of the index,
+    including versions of the file that were replaced since. A shard
+    passes df and n_files of the whole collection."""
+    if n_files is None:
+        n_files = sum(len(seg[1]) for seg in segments)
+    scores = dict.fromkeys(fns, 0)
+    for tok in tokens:
+        tok_df = 0
+        freqs = defaultdict(int)
+        for _, seg_fl, seg_index, *_ in segments:
+            occ_list = seg_index.get(tok, ())
+            tok_df += len(occ_list)
+            for doc_id, freq, _ in occ_list:
+                fn = seg_fl[doc_id]
+                if fn in scores:
+                    freqs[fn] += freq
+
+        idf = math.log10(n_files/(df[tok] if df else tok_df))
+        for fn in scores:
+            scores[fn] += (1 + math.log10(freqs[fn])) * idf
+    return scores
+
+
+def bm25Scores(tokens, r_index, doc_lengths, candidates=None, k1=K1, b=B,
+               df=None, n_docs=None, avgdl=None):
+    """ doc_id : summed BM25 of tokens, for the doc ids in candidates (a
+    set) or for every document with one of the tokens
+
+    doc_lengths[doc_id] is the number of tokens of the document, None for
+    documents no longer in the index. A shard passes df, n_docs and avgdl
+    of the whole collection, otherwise they are those of r_index."""
+    if n_docs is None:
+        lengths = doc_lengths
+        if None in lengths:
+            lengths = [n for n in lengths if n is not None]
+        n_docs = len(lengths)
+        avgdl = sum(lengths) / n_docs if n_docs else 1
+
+    scores = defaultdict(float)
+    for tok in tokens:
+        occ_list = r_index[tok]
+        tok_df = df[tok] if df else len(occ_list)
+        idf = math.log(1 + (n_docs - tok_df + 0.5) / (tok_df + 0.5))
+        for doc_id, freq, _ in occ_list:
+            if candidates is None or doc_id in candidates:
+                norm = k1 * (1 - b + b * doc_lengths[doc_id] / avgdl)
+                scores[doc_id] += idf * freq * (k1 + 1) / (freq + norm)
+    return scores
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# Segments of an incrementally updated index
+#
+# The index of a directory is an ordered list of segments, kept in mir.seg.
+# The first one is the base (mir, unless a merge replaced it). Every
+# mir.py -A run appends a new immutable segment with the files added or
+# modified since, and <segment>.rem with the files it deletes. Reading the
+# segments in order, each one first removes its .rem files and then adds
+# its own, so the newest segment holding a file wins.
+#
+# Merges replace consecutive segments by one with the same contents. Their
+# files are removed once no query started before the new mir.seg is still
+# reading them: queries hold mir.read.lock shared, removals exclusive.
+import fcntl
+import os
+import pickle
+from contextlib import contextmanager
+
+import mirbin
+
+MANIFEST = 'mir.seg'
+LOCK = 'mir.lock'
+MERGE_LOCK = 'mir.merge.lock'
+READ_LOCK = 'mir.read.lock'
+BASE = 'mir'
+# more segments than this are merged whatever their sizes
+MAX_SEGMENTS = 16
+
+
+def manifestPath(rootdir):
+    return '{}/{}'.format(rootdir, MANIFEST)
+
+
+def loadManifest(rootdir):
+    """ {'segments': names in order, 'next': number of the next segment}"""
+    try:
+        with open(manifestPath(rootdir), 'rb') as handle:
+            return pickle.load(handle)
+    except FileNotFoundError:
+        # indexes from before mir.seg have at most one auxiliary, mira
+        if os.path.isfile('{}/mira.pickle'.format(rootdir)):
+            return {'segments': [BASE, 'mira'], 'next': 2}
+        return {'segments': [BASE], 'next': 1}
+
+
+def saveManifest(rootdir, manifest):
+    tmp = manifestPath(rootdir) + '.tmp'
+    with open(tmp, 'wb') as handle:
+        pickle.dump(manifest, handle)
+    # readers see either the old or the new list
+    os.replace(tmp, manifestPath(rootdir))
+
+
+def segmentNames(rootdir):
+    return loadManifest(rootdir)['segments']
+
+
+@contextmanager
+def locked(rootdir, blocking=True, lock=LOCK, shared=False):
+    """ Hold lock, yields False if not blocking and someone else has it"""
+    with open('{}/{}'.format(rootdir, lock), 'a') as handle:
+        try:
+            fcntl.flock(handle,
+                        (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+@contextmanager
+def reading(rootdir):
+    """ Keep the files of the segments from being removed meanwhile"""
+    if not os.access(rootdir, os.W_OK):
+        # nobody can remove them from a read-only index either
+        yield
+        return
+    with locked(rootdir, lock=READ_LOCK, shared=True):
+        yield
+
+
+def reserveName(rootdir):
+    """ Unused segment name: mira, mira2, mira3, ..."""
+    with locked(rootdir):
+        manifest = loadManifest(rootdir)
+        n = manifest['next']
+        manifest['next'] = n + 1
+        saveManifest(rootdir, manifest)
+    return 'mira' if n == 1 else 'mira{}'.format(n)
+
+
+def appendSegment(rootdir, name):
+    with locked(rootdir):
+        manifest = loadManifest(rootdir)
+        manifest['segments'].append(name)
+        saveManifest(rootdir, manifest)
+
+
+def replaceSegments(rootdir, old_names, new_name):
+    """ Put new_name in place of the consecutive segments old_names
+
+    Returns False, changing nothing, if they are no longer in the list."""
+    with locked(rootdir):
+        manifest = loadManifest(rootdir)
+        segments = manifest['segments']
+        if old_names[0] not in segments:
+            return False
+        i = segments.index(old_names[0])
+        if segments[i:i+len(old_names)] != old_names:
+            return False
+        segments[i:i+len(old_names)] = [new_name]
+        saveManifest(rootdir, manifest)
+    return True
+
+
+def resetSegments(rootdir):
+    """ Forget every segment but a freshly built base"""
+    with locked(rootdir):
+        old_names = segmentNames(rootdir)
+        saveManifest(rootdir, {'segments': [BASE], 'next': 1})
+    removeSegments(rootdir, [name for name in old_names if name != BASE])
+
+
+def removedPath(rootdir, name):
+    return '{}/{}.rem'.format(rootdir, name)
+
+
+def readRemoved(rootdir, name):
+    """ Files deleted by segment name"""
+    try:
+        with open(removedPath(rootdir, name), 'r') as handle:
+            return [line.split()[-1] for line in handle if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def writeRemoved(rootdir, name, rm_files):
+    with open(removedPath(rootdir, name), 'w+') as handle:
+        handle.writelines(['@x {}\n'.format(fn) for fn in rm_files])
+
+
+def segmentFiles(rootdir, name):
+    paths = ['{}/{}{}'.format(rootdir, name, suffix)
+             for suffix in ('.pickle', 'p.pickle', 'o.pickle', 's.pickle',
+                           't.pickle', '.rem')]
+    return paths + mirbin.indexPaths(rootdir, name)
+
+
+def segmentSize(rootdir, name):
+    """ Bytes on disk of segment name"""
+    return sum(os.path.getsize(path) for path in segmentFiles(rootdir, name)
+               if os.path.isfile(path))
+
+
+def removeSegmentFiles(rootdir, name):
+    for path in segmentFiles(rootdir, name):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def removeSegments(rootdir, names):
+    """ Remove the files of segments no longer in mir.seg, once the queries
+    that may still read them (see reading) are done"""
+    if not names:
+        return
+    with locked(rootdir, lock=READ_LOCK):
+        for name in names:
+            removeSegmentFiles(rootdir, name)
+
+
+def liveSources(segments):
+    """ fn : name of the segment holding its current version, and how
+    many versions were deleted or replaced on the way
+
+    segments is a list of (name, filelist, removed files), in order."""
+    live = {}
+    n_dead = 0
+    for name, filelist, rm_files in segments:
+        for fn in rm_files:
+            if live.pop(fn, None) is not None:
+                n_dead += 1
+        for fn in filelist:
+            if fn in live:
+                n_dead += 1
+            live[fn] = name
+    return live, n_dead
+
+
+def mergeCandidates(sizes, max_segments=MAX_SEGMENTS):
+    """ Indexes of consecutive segments to merge, [] if none
+
+    The newest segments are merged with the one before them once they add
+    up to at least its size, so sizes decrease geometrically from the base
+    and there are about log2(total / update size) segments, like the bits
+    of a binary counter. Past max_segments, the newest are merged anyway."""
+    if len(sizes) > max_segments:
+        return list(range(max_segments - 1, len(sizes)))
+    newer = 0
+    for i in range(len(sizes) - 1, 0, -1):
+        newer += sizes[i]
+        if newer >= sizes[i-1]:
+            return list(range(i - 1, len(sizes)))
+    return []
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# Long-lived query server for mirs.py and its client
+#
+# The server loads the combined index once and answers each connection with
+# the output mirs.py would have printed for the same arguments. The request
+# is a single JSON line {"dir": ..., "argv": [...]}, the answer is the text.
+import io
+import json
+import os
+import socket
+import socketserver
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+import mirdict
+import mirs
+import mirseg
+import mirshard
+import mirstat
+
+HOST = '127.0.0.1'
+
+
+class QueryServer(socketserver.TCPServer):
+    # One query at a time: queries print to a redirected sys.stdout
+    allow_reuse_address = True
+
+    def __init__(self, args, port):
+        self.args = args
+        self.rootdir = os.path.realpath(args.dir)
+        self.generation = None
+        self.load_msg = ''
+        self.filelist = self.r_index = self.stats = None
+        self.dictionaries = None
+        with mirseg.reading(args.dir):
+            self.reloadIfChanged()
+        super().__init__((HOST, port), QueryHandler)
+
+    def reloadIfChanged(self):
+        generation = mirs.indexGeneration(self.args.dir)
+        if generation == self.generation:
+            return
+
+        out = io.StringIO()
+        try:
+            with redirect_stdout(out):
+                filelist, r_index = mirs.loadCombinedIndex(self.args)
+                stats = mirstat.indexStats(self.args.dir)
+                dictionaries = mirdict.loadDictionaries(self.args.dir)
+        except Exception:
+            # Probably caught mir.py halfway through writing the index,
+            # keep serving the old one and try again on the next query
+            if self.r_index is None:
+                raise
+            print('Falha ao recarregar o índice:\n' + traceback.format_exc())
+            return
+
+        if isinstance(self.r_index, mirshard.ShardedIndex):
+            # stop the processes serving the old shards
+            self.r_index.close()
+        self.filelist, self.r_index, self.stats = filelist, r_index, stats
+        self.dictionaries = dictionaries
+        self.load_msg = out.getvalue()
+        self.generation = generation
+        print(self.load_msg, end='')
+
+    def answer(self, request):
+        if os.path.realpath(request['dir']) != self.rootdir:
+            return 'Este servidor atende o diretório {}\n'.format(
+                self.rootdir)
+
+        with mirseg.reading(self.args.dir):
+            return self.query(request)
+
+    def query(self, request):
+        self.reloadIfChanged()
+
+        out = io.StringIO()
+        with redirect_stdout(out), redirect_stderr(out):
+            try:
+                args = mirs.getArgs(request['argv'])
+                args.dir = self.args.dir
+                mirs.cachedQuery(args, self.filelist, self.r_index,
+                                 self.generation, self.stats,
+                                 self.dictionaries)
+            except SystemExit:
+                pass
+            except Exception:
+                traceback.print_exc()
+
+        return self.load_msg + out.getvalue()
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        self.wfile.write(self.server.answer(request).encode('utf-8'))
+
+
+def serve(args, port):
+    with QueryServer(args, port) as server:
+        print('Servidor MIR de {} em {}:{}'.format(args.dir, HOST, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def query(port, rootdir, argv):
+    """ Output of mirs.py <argv> as computed by the server on port"""
+    request = json.dumps({'dir': os.path.realpath(rootdir),
+                          'argv': argv}) + '\n'
+
+    with socket.create_connection((HOST, port)) as sock:
+        sock.sendall(request.encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return b''.join(chunks).decode('utf-8')
@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# Document-partitioned (sharded) indexes, built by mir.py -S
+#
+# The file list is split in contiguous slices of about the same number of
+# bytes and each one is indexed on its own, as segment mir_<k> with the
+# postings, positions, mirstat statistics and mirdict dictionary of its
+# documents only. mir.shd lists the shards and the global doc id of the
+# first document of each, so doc ids are those of an unsharded index.
+#
+# mirs.py queries them through a ShardedIndex: every shard stays loaded in
+# a worker process of its own, each query is sent to all of them (scatter)
+# and their answers are merged (gather). That takes two rounds. The first
+# one finds the documents of each term, giving its DF in the whole
+# collection. The second one ranks with those, with the number of
+# documents and tokens summed over the shards when they were built, so
+# scores and rankings are the same as those of an unsharded index. Top-k
+# modes only send back each shard's k best documents.
+import os
+import pickle
+from multiprocessing import Pool
+
+import mircache
+import mirdict
+import mirprof
+import mirs
+import mirseg
+import mirstat
+from mirpost import Postings
+from mirprox import isPhrase, minimumWindow, orderedWindow
+from mirquery import conjunctiveQuery, topK
+from mirscore import bm25Scores, quaseScores, tfIdfScores
+
+MANIFEST = 'mir.shd'
+
+# read by the shard workers
+DICTIONARIES = mircache.LRUCache(mircache.SEGMENTS_SIZE, 'dictionaries')
+STATS = mircache.LRUCache(mircache.SEGMENTS_SIZE, 'stats')
+
+
+def shardName(k):
+    return 'mir_{}'.format(k)
+
+
+def partition(sizes, n_shards):
+    """ Bounds (first, end) of at most n_shards contiguous slices of sizes,
+    each adding up to about the same"""
+    total = sum(sizes)
+    bounds = []
+    first = acc = 0
+    for i, size in enumerate(sizes):
+        acc += size
+        if (len(bounds) < n_shards - 1
+                and acc * n_shards >= total * (len(bounds) + 1)):
+            bounds.append((first, i + 1))
+            first = i + 1
+    if first < len(sizes):
+        bounds.append((first, len(sizes)))
+    return bounds
+
+
+def manifestPath(rootdir):
+    return '{}/{}'.format(rootdir, MANIFEST)
+
+
+def isSharded(rootdir):
+    return os.path.isfile(manifestPath(rootdir))
+
+
+def loadManifest(rootdir):
+    """ {'shards': names, 'first': global doc id of the first document of
+    each, 'documents': number of documents, 'tokens': number of tokens}"""
+    with open(manifestPath(rootdir), 'rb') as handle:
+        return pickle.load(handle)
+
+
+def saveManifest(rootdir, manifest):
+    """ Make manifest the index of rootdir, removing shards it dropped"""
+    old_names = loadManifest(rootdir)['shards'] if isSharded(rootdir) else []
+    tmp = manifestPath(rootdir) + '.tmp'
+    with open(tmp, 'wb') as handle:
+        pickle.dump(manifest, handle)
+    os.replace(tmp, manifestPath(rootdir))
+    for name in old_names:
+        if name not in manifest['shards']:
+            mirseg.removeSegmentFiles(rootdir, name)
+
+
+def removeShards(rootdir):
+    """ Forget a sharded index, after an unsharded one replaced it"""
+    if not isSharded(rootdir):
+        return
+    names = loadManifest(rootdir)['shards']
+    os.remove(manifestPath(rootdir))
+    for name in names:
+        mirseg.removeSegmentFiles(rootdir, name)
+
+
+def openShard(rootdir, name):
+    """ (filelist, r_index, encoding_dic, dictionary) of shard name, kept
+    loaded by the process"""
+    filelist, r_index, encoding_dic = mirs.readSegment(rootdir, name)
+    dictionary = mirs.readCached(DICTIONARIES, mirdict.loadDictionary,
+                                 rootdir, name)
+    return filelist, r_index, encoding_dic, dictionary
+
+
+def shardPostings(r_index, dictionary, tok):
+    """ (terms, postings) of query term tok in a shard, terms are those it
+    matched if it is a pattern, otherwise None"""
+    if not mirdict.isPattern(tok):
+        return None, r_index.get(tok)
+
+    if dictionary is None:
+        dictionary = mirdict.TermDictionary(r_index.keys(), index_grams=False)
+    terms = [term for term in mirdict.expandPattern([dictionary], tok)
+             if term in r_index]
+    if not terms:
+        return terms, None
+    return terms, Postings.union(r_index[term] for term in terms)
+
+
+def findTerms(rootdir, name, first, tokens):
+    """ (terms, global doc ids) of each of tokens in one shard"""
+    _, r_index, _, dictionary = openShard(rootdir, name)
+    answer = []
+    for tok in tokens:
+        terms, occ_list = shardPostings(r_index, dictionary, tok)
+        answer.append((terms, [first + doc_id for doc_id, _, _ in occ_list]
+                       if occ_list else []))
+    return answer
+
+
+def rankShard(rootdir, name, first, query):
+    """ (number of documents matched, rows) of one shard, see
+    ShardedIndex.rank"""
+    filelist, r_index, encoding_dic, dictionary = openShard(rootdir, name)
+    occ = {}
+    for tok in query['tokens']:
+        occ_list = shardPostings(r_index, dictionary, tok)[1]
+        if occ_list:
+            occ[tok] = occ_list
+    tokens = [tok for tok in query['tokens'] if tok in occ]
+    mode, k, df = query['order'], query['k'], query['df']
+    n_docs = query['documents']
+
+    def lengths():
+        return mirs.readCached(STATS, mirstat.loadStats,
+                               rootdir, name)['lengths']
+
+    def ranked(scores, candidates):
+        best = sorted(((doc_id, scores[doc_id]) for doc_id in candidates),
+                      key=lambda x: (-x[1], x[0]))
+        return best[:k]
+
+    if query['or']:
+        if mode == 7:
+            scores = bm25Scores(tokens, occ, lengths(), df=df, n_docs=n_docs,
+                                avgdl=query['avgdl'])
+            best = ranked(scores, list(scores))
+        else:
+            best = topK(tokens, occ, n_docs, k, df=df)
+        return len(best), [(first + doc_id, score, filelist[doc_id])
+                           for doc_id, score in best]
+
+    if len(tokens) < len(query['tokens']):
+        # some term has no document in this shard
+        return 0, []
+    documents = conjunctiveQuery(tokens, occ, filelist)
+    candidates = {doc_id for doc_id, _ in documents}
+
+    if mode == 0:
+        rows = [(first + doc_id, fn) for doc_id, fn in documents]
+    elif mode == 1 and k is not None:
+        best = topK(tokens, occ, n_docs, k, sorted(candidates), df)
+        rows = [(first + doc_id, score, filelist[doc_id])
+                for doc_id, score in best]
+    elif mode == 1:
+        scores = tfIdfScores(tokens, occ, n_docs, candidates, df)
+        rows = [(first + doc_id, scores[doc_id], fn)
+                for doc_id, fn in documents]
+    elif mode == 7:
+        scores = bm25Scores(tokens, occ, lengths(), candidates, df=df,
+                            n_docs=n_docs, avgdl=query['avgdl'])
+        rows = [(first + doc_id, score, filelist[doc_id])
+                for doc_id, score in ranked(scores, candidates)]
+    elif mode == 2:
+        scores = quaseScores([fn for _, fn in documents], tokens,
+                             [(name, filelist, occ)], df, n_docs)
+        rows = [(first + doc_id, scores[fn], fn) for doc_id, fn in documents]
+    elif mode in (3, 4, 5, 6):
+        rows = windowRows(rootdir, name, first, documents, occ, query)
+    else:
+        rows = []
+    return len(documents), rows
+
+
+def windowRows(rootdir, name, first, documents, occ, query):
+    """ (global doc id, window size, fn, snippet) of the documents where
+    the window of modes 3 to 6 is found"""
+    mode, window_tokens = query['order'], query['window']
+    encoding_dic = openShard(rootdir, name)[2]
+    pos_list = mirs.readCached(mirs.POSITION_LISTS, mirs.loadPositionList,
+                               rootdir, name)
+    checkpoints = None
+    if query['verbose']:
+        checkpoints = mirs.readCached(mirs.CHECKPOINTS, mirs.loadCheckpoints,
+                                      rootdir, name)
+
+    rows = []
+    for doc_id, fn in documents:
+        position_lists = [mirs.termPositions(occ, tok, doc_id, pos_list)
+                          for tok in window_tokens]
+        if mode in (5, 6):
+            window = orderedWindow(position_lists)
+        else:
+            window = minimumWindow(position_lists)
+        if window is None or (
+                mode == 6 and not isPhrase(window, len(window_tokens))):
+            continue
+        rows.append((first + doc_id, mirs.posDif(window), fn,
+                     mirs.readInterval(
+                         query['verbose'], window, os.path.join(rootdir, fn),
+                         encoding_dic[fn],
+                         checkpoints[doc_id] if checkpoints else None,
+                         window_tokens)))
+    return rows
+
+
+class ShardedIndex:
+    """ Coordinator of the shards of rootdir, each one served by a worker
+    process"""
+
+    def __init__(self, rootdir):
+        manifest = loadManifest(rootdir)
+        self.rootdir = rootdir
+        self.names = manifest['shards']
+        self.first = manifest['first']
+        self.n_docs = manifest['documents']
+        self.avgdl = (manifest['tokens'] / self.n_docs if self.n_docs
+                      else 1)
+        self.stats = None
+        self.pools = [Pool(1) for _ in self.names]
+
+    def close(self):
+        for pool in self.pools:
+            pool.terminate()
+
+    def scatter(self, function, *args):
+        """ function(rootdir, name, first, *args) on every shard at once,
+        results in shard order"""
+        pending = [pool.apply_async(function,
+                                    (self.rootdir, name, first) + args)
+                   for pool, name, first
+                   in zip(self.pools, self.names, self.first)]
+        return [result.get() for result in pending]
+
+    def statistics(self):
+        """ DF of every term and terms by decreasing DF, summed from the
+        shards' mirstat tables"""
+        if self.stats is None:
+            df = {}
+            for name in self.names:
+                for tok, n in mirstat.loadStats(self.rootdir,
+                                                name)['df'].items():
+                    df[tok] = df.get(tok, 0) + n
+            self.stats = {'df': df, 'by_df': sorted(
+                df, key=lambda tok: (-df[tok], tok))}
+        return self.stats
+
+    def docIds(self, tokens):
+        """ (terms, global doc ids) of each of tokens in the whole index"""
+        answers = self.scatter(findTerms, tokens)
+        found = []
+        for i in range(len(tokens)):
+            terms = [answer[i][0] for answer in answers]
+            found.append((
+                None if terms[0] is None else sorted(set().union(*terms)),
+                [doc_id for answer in answers for doc_id in answer[i][1]]))
+        return found
+
+    def expandQuery(self, query):
+        """ Like mirs.expandQuery, but returns the DF of each term found"""
+        tokens = []
+        df = {}
+        for tok, (terms, doc_ids) in zip(query, self.docIds(query)):
+            if terms is not None:
+                if not terms:
+                    print('\tPadrão {} não encontrado.'.format(tok))
+                    continue
+                print('\tPadrão {} expandido em {} termos: {}'.format(
+                    tok, len(terms), ' '.join(terms)))
+            elif not doc_ids:
+                print('\tToken {} não encontrado.'.format(tok))
+                continue
+            print('\t{:2d}\t{: <10}\t{}'.format(len(doc_ids), tok, doc_ids))
+            tokens.append(tok)
+            df[tok] = len(doc_ids)
+        return tokens, df
+
+    def rank(self, tokens, df, args, window_tokens=None, k=None):
+        """ (number of documents matched, rows) gathered from the shards
+
+        Rows are (doc id, fn) for -o 0, (doc id, score, fn) when ranking
+        and (doc id, window size, fn, snippet) for the windows of -o 3 to
+        6, sorted as mirs.py prints them."""
+        query = {'tokens': tokens, 'window': window_tokens,
+                 'order': args.order, 'k': k, 'or': args.disjunctive,
+                 'df': df, 'documents': self.n_docs, 'avgdl': self.avgdl,
+                 'verbose': args.v}
+        answers = self.scatter(rankShard, query)
+        n_docs = sum(n for n, _ in answers)
+        rows = [row for _, shard_rows in answers for row in shard_rows]
+        if args.disjunctive or (args.order == 1 and k is not None) \
+                or args.order == 7:
+            rows.sort(key=lambda row: (-row[1], row[0]))
+            rows = rows[:k]
+        elif args.order in (1, 2):
+            # stable, ties stay in doc id order
+            rows.sort(key=lambda row: row[1], reverse=True)
+        elif args.order != 0:
+            rows.sort(key=lambda row: row[1])
+        return n_docs, rows
+
+    def printTopTokens(self, args):
+        stats = self.statistics()
+        dictionaries = None
+        if args.r or args.R:
+            dictionaries = mirdict.loadDictionaries(self.rootdir, self.names)
+        with mirprof.phase('filter'):
+            top_tokens = mirs.filterTokens(args, stats['by_df'], True,
+                                           dictionaries)[:args.t]
+
+        print('\tDF\tTermo/Token\tLista de incidência com IDs dos arquivos')
+
+        n_postings = 0
+        for tok, (_, doc_ids) in zip(top_tokens, self.docIds(top_tokens)):
+            print('\t{:2d}\t{: <10}\t{}'.format(
+                stats['df'][tok], tok, doc_ids))
+            n_postings += len(doc_ids)
+
+        mirs.printEndMsg(args, len(top_tokens), n_postings)
+
+    def runQuery(self, args):
+        """ What mirs.runQuery prints for the same arguments"""
+        if args.t is not None:
+            self.printTopTokens(args)
+
+        if args.tokens == [[]]:
+            return
+
+        print("\nConjugação das listas de incidência dos {} termos seguintes."
+              .format(len(args.tokens[0])))
+
+        print('\tDF\tTermo/Token\tLista de incidência com IDs dos arquivos')
+
+        patterns = [tok for tok in args.tokens[0] if mirdict.isPattern(tok)]
+        if patterns and args.order not in (0, 1, 7):
+            print('Padrões só são suportados com -o 0, 1 ou 7')
+            exit(1)
+
+        query_order = list(args.tokens[0])
+        args.tokens[0].sort(reverse=True)
+
+        with mirprof.phase('expand'):
+            tokens, df = self.expandQuery(args.tokens[0])
+
+        if args.order in (5, 6):
+            # ordered modes need the terms as typed
+            tokens = [tok for tok in query_order if tok in df]
+
+        if args.disjunctive:
+            if args.order not in (1, 7):
+                print('--or só é suportado com -o 1 ou 7')
+                exit(1)
+
+            k = args.k if args.k is not None else self.n_docs
+            with mirprof.phase('scoring'):
+                _, ranked = self.rank(tokens, df, args, k=k)
+            print("Os {} documentos mais relevantes com algum dos {} termos"
+                  .format(len(ranked), len(tokens)))
+            for row in ranked:
+                print("\t{:2d}\t{:.2f}\t{}".format(*row))
+            return
+
+        window_tokens = tokens
+        if args.order == 4:
+            window_tokens = sorted(tokens, key=lambda tok: df[tok])[:2]
+
+        with mirprof.phase('scoring'):
+            n_docs, rows = self.rank(tokens, df, args, window_tokens, args.k)
+        mirprof.count('results', n_docs)
+
+        print("São {} os documentos com os {} termos"
+              .format(n_docs, len(tokens)))
+
+        if args.order < 0 or args.order > 7:
+            print('WRONG VALUE FOR -o')
+            exit(1)
+
+        if args.order in (5, 6):
+            print("Em {} deles os termos aparecem {}".format(
+                len(rows), 'na ordem' if args.order == 5 else 'como frase'))
+
+        for row in rows:
+            if args.order == 0:
+                print("\t{:2d}\t{}".format(*row))
+            elif args.order in (1, 2, 7):
+                print("\t{:2d}\t{:.2f}\t{}".format(*row))
+            else:
+                print("\t{:2d}\t{:2d}\t{}\t{}".format(*row))
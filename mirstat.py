@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# Collection statistics saved next to each segment, in <segment>s.pickle
+#
+# A dict with
+#   'df':       token : document frequency
+#   'by_df':    tokens by decreasing DF, ties in alphabetical order
+#   'lengths':  doc_id : number of tokens, array('I')
+# so mirs.py -t and the ranking modes don't derive them from the postings.
+import pickle
+from array import array
+
+import mirseg
+
+
+class TermStats:
+    """ Accumulates the statistics one postings list at a time"""
+
+    def __init__(self, n_docs):
+        self.df = {}
+        self.lengths = array('I', bytes(4 * n_docs))
+
+    def add(self, tok, docs, freqs):
+        self.df[tok] = len(docs)
+        lengths = self.lengths
+        for doc_id, freq in zip(docs, freqs):
+            lengths[doc_id] += freq
+
+    def table(self):
+        df = self.df
+        return {'df': df,
+                'by_df': sorted(df, key=lambda tok: (-df[tok], tok)),
+                'lengths': self.lengths}
+
+
+def termStatistics(r_index, n_docs):
+    """ Statistics table of an index held in memory"""
+    stats = TermStats(n_docs)
+    # in token order, like a streamed build, so both save the same table
+    for tok in sorted(r_index):
+        occ_list = r_index[tok]
+        stats.add(tok, occ_list.docs, occ_list.freqs)
+    return stats.table()
+
+
+def statsPath(rootdir, name):
+    return '{}/{}s.pickle'.format(rootdir, name)
+
+
+def saveStats(rootdir, name, table):
+    with open(statsPath(rootdir, name), 'w+b') as handle:
+        pickle.dump(table, handle, pickle.HIGHEST_PROTOCOL)
+
+
+def loadStats(rootdir, name):
+    """ Statistics table of segment name, None for indexes without it"""
+    try:
+        with open(statsPath(rootdir, name), 'rb') as handle:
+            return pickle.load(handle)
+    except FileNotFoundError:
+        return None
+
+
+def indexStats(rootdir):
+    """ Statistics table of the whole index, None unless it is a single
+    segment: those of several segments don't add up once -A replaced or
+    deleted files"""
+    names = mirseg.segmentNames(rootdir)
+    if len(names) != 1:
+        return None
+    return loadStats(rootdir, names[0])
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Tokenizer shared by the indexer (mir.py) and the searcher (mirs.py)
+#
+# A token is a maximal run of letters (word characters that are neither
+# digits nor '_'), lowercased.
+import codecs
+import re
+
+resplit = re.compile(r'[\W\d_\s]+')
+retoken = re.compile(r'[^\W\d_]+')
+
+CHUNK_SIZE = 1 << 16
+# chunk size when recording checkpoints, bounds how much a snippet reads
+CHECKPOINT_SIZE = 1 << 14
+
+# Files of mixed UTF-8 and Windows-1252 are read with errors='mixed'
+mixed_miscoded_espurious = {b'\x81': 1,
+                            b'\x8d': 1,
+                            b'\x90': 1,
+                            b'\x9d': 1,
+                            b'\x91': 1}
+
+
+def mixed_decoder(error: UnicodeDecodeError) -> (str, int):
+    global mixed_miscoded_espurious
+    """ Trata erros de decodificação Unicode como sendo Windows-1252"""
+
+    bs: bytes = error.object[error.start: error.end]
+
+    if bs in mixed_miscoded_espurious:  # ignored
+        return '', error.start + 1
+    else:
+        return bs.decode("Windows-1252"), error.start + 1
+    return bs.decode("Windows-1252", errors='ignore'), error.start + 1
+
+
+codecs.register_error("mixed", mixed_decoder)
+
+
+def iterTokensByLine(handle):
+    """ Original tokenizer: split and lowercase every line and word"""
+    return (
+        word.lower()
+        for line in handle
+        for word in resplit.split(line)
+        if word != ''
+    )
+
+
+def tokenPositionsByLine(handle):
+    """ Original counting loop over iterTokensByLine, kept for benchmarks"""
+    token_freq = {}
+    token_pos = {}
+    for i, token in enumerate(iterTokensByLine(handle)):
+        if token != '':
+            if token_freq.get(token) is None:
+                token_freq[token] = 1
+                token_pos[token] = [i]
+            else:
+                token_freq[token] += 1
+                token_pos[token].append(i)
+
+    return token_freq, token_pos
+
+
+def iterTokenChunks(handle, chunk_size=CHUNK_SIZE, checkpoints=None):
+    """ Lists of the tokens of handle, read chunk_size characters at a time
+
+    Each chunk is lowercased at once and scanned with a single regex. The
+    token touching the end of a chunk may continue in the next one, so it
+    is carried over instead of being emitted.
+
+    If a checkpoints list is given, a (token index, handle.tell(), partial)
+    tuple is appended before each read, see iterTokensFrom."""
+    carry = ''
+    n_tokens = 0
+    while True:
+        if checkpoints is not None:
+            # the carried token starts before this point
+            checkpoints.append(
+                (n_tokens + (1 if carry else 0), handle.tell(), bool(carry)))
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            if checkpoints is not None:
+                checkpoints.pop()
+            break
+        chunk = carry + chunk
+
+        end = len(chunk)
+        while end > 0 and retoken.match(chunk[end-1]):
+            end -= 1
+        chunk, carry = chunk[:end], chunk[end:]
+
+        lowered = chunk.lower()
+        # Lowering the whole chunk is only safe when it maps each character
+        # to exactly one character without looking at its neighbours (final
+        # sigma does)
+        if len(lowered) == len(chunk) and 'Σ' not in chunk:
+            tokens = retoken.findall(lowered)
+        else:
+            tokens = [token.lower() for token in retoken.findall(chunk)]
+        n_tokens += len(tokens)
+        yield tokens
+
+    if carry:
+        yield [carry.lower()]
+
+
+def iterTokens(handle, chunk_size=CHUNK_SIZE):
+    """ Same tokens as iterTokensByLine, see iterTokenChunks"""
+    for tokens in iterTokenChunks(handle, chunk_size):
+        yield from tokens
+
+
+def iterTokensFrom(handle, checkpoint):
+    """ (index, token) of handle from a checkpoint of iterTokenChunks"""
+    token_index, cookie, partial = checkpoint
+    handle.seek(cookie)
+    if partial:
+        # the checkpoint may split a token, whose tail is not a token
+        first = handle.read(1)
+        handle.seek(cookie)
+        partial = bool(first) and retoken.match(first) is not None
+
+    tokens = iterTokens(handle, CHECKPOINT_SIZE)
+    if partial:
+        next(tokens, None)
+    return enumerate(tokens, token_index)
+
+
+def tokenPositions(handle, chunk_size=CHUNK_SIZE, checkpoints=None):
+    """ token : positions of token in handle, in order of first occurrence"""
+    token_pos = {}
+    get = token_pos.get
+    n_tokens = 0
+    for tokens in iterTokenChunks(handle, chunk_size, checkpoints):
+        for i, token in enumerate(tokens, n_tokens):
+            pos = get(token)
+            if pos is None:
+                token_pos[token] = [i]
+            else:
+                pos.append(i)
+        n_tokens += len(tokens)
+
+    return token_pos
@@ -4,3 +4,10 @@ tar xvzf arquivos.tgz
 touch diretório/arq0.txt
 rm diretório/arq1.txt
 ./mir.py -A diretório/
+# -H: an edit that keeps size and mtime is indexed only once
+./mir.py -H diretório/
+touch -r diretório/arq2.txt diretório/mtime.ref
+sed -i '0,/a/s//e/' diretório/arq2.txt
+touch -r diretório/mtime.ref diretório/arq2.txt
+./mir.py -A -H diretório/ | grep 'Dos quais, 1 foram atualizados' > /dev/null || echo 'FALHA: -A -H não viu a edição de arq2.txt'
+./mir.py -A -H diretório/ | grep 'Índice em dia' > /dev/null || echo 'FALHA: -A -H indexou arq2.txt de novo'